@@ -1,4 +1,3 @@
-import random
 import sys
 from enum import Enum, auto
 
@@ -65,12 +64,26 @@ class BinaryFeature(object):
         return self.value == other.value
 
 
+_features_module = None
+
+
+def _features():
+    """The features module, imported on first use: it builds on the feature classes above, so it can't be
+    imported at the top of this file"""
+    global _features_module
+    if _features_module is None:
+        import features
+        _features_module = features
+    return _features_module
+
+
 class Agent:
     """An agent with the ability to make decisions"""
     satisfaction_threshold = 0.5
 
     def __init__(self, religion: CategoricalFeature, ethnicity: BinaryFeature, income: RealNumberFeature, landmark,
-                 weights=None):
+                 weights=None, **features):
+        """:param features: feature objects of the features registered in features.py, by name"""
         self.religion = religion
         self.ethnicity = ethnicity
         self.income = income
@@ -79,48 +92,39 @@ class Agent:
             weights = [0, 1, 0]
         self.weights = weights
         self.landmark = landmark
-
-    def income_satisfaction_calculation(self, other_income):
-        sat = min(self.income.value, other_income.value)/max(self.income.value, other_income.value)
-        return sat
+        for name, feature in features.items():
+            setattr(self, name, feature)
 
     # Whether an agent is satisfied with their current position
-    def satisfied(self, neighbors):
-        # First put all the satisfactions in arrays, for each feature and each non-landmark neighbor
-        if self.weights[0]!=0:
-            neighbor_religion_satisfactions = [self.religion.preference(n.religion) for n in neighbors if not n.landmark]
-        else:
-            neighbor_religion_satisfactions = [0]
-        if self.weights[1]!=0:
-            neighbor_ethnicity_satisfactions = [self.ethnicity.preference(n.ethnicity) for n in neighbors if not n.landmark]
-        else:
-            neighbor_ethnicity_satisfactions = [0]
-        if self.weights[2]!=0:
-            neighbor_income_satisfactions = [self.income_satisfaction_calculation(n.income) for n in neighbors if not n.landmark]
-        else:
-            neighbor_income_satisfactions = [0]
-        # Calculate the average satisfaction for each feature
-        avg_neighbor_religion_satisfaction = np.average(neighbor_religion_satisfactions)
-        avg_neighbor_ethnicity_satisfaction = np.average(neighbor_ethnicity_satisfactions)
-        avg_neighbor_income_satisfaction = np.average(neighbor_income_satisfactions)
+    def satisfied(self, neighbors, landmark_influence=None):
+        """:param landmark_influence: how much landmarks raise the agent's religion satisfaction, looked up in a
+        landmark.LandmarkIndex. If None, the neighbors are scanned for landmarks of a liked religion"""
+        features = _features()
+        weights = features.feature_weights(self.weights)
+        others = [n for n in neighbors if not n.landmark]
+        # The average satisfaction with the non-landmark neighbors for each feature, compared all at once
+        satisfactions = []
+        for feature, weight in zip(features.registry, weights):
+            if weight == 0:
+                satisfactions.append(0)
+            elif not others:
+                satisfactions.append(np.nan)
+            else:
+                own = getattr(self, feature.name)
+                values = [getattr(n, feature.name).value for n in others]
+                matches = feature.matches(own.value, values, getattr(own, "preference_matrix", None))
+                satisfactions.append(matches.sum() / len(values))
 
         # If there is a landmark within the neighbors that shares a religion with the agent
         # then maximise religion satisfaction
-
-        # Check if one of the neighbors is a landmark
-        # If the religion of the agent matches the landmark's religion, change religious satisfaction
-        for n in neighbors:
-            if n.landmark:
-                if self.religion.preference(n.religion):
-                    avg_neighbor_religion_satisfaction = 1
-
-        # 3 arrays can be treated as a matrix, np.average averages all of the numbers
-        self.satisfaction = np.average(a=[avg_neighbor_religion_satisfaction,
-                                          avg_neighbor_ethnicity_satisfaction,
-                                          avg_neighbor_income_satisfaction], weights=self.weights)
-
-        # Returns a list where the first element is whether they're satisfied or not, and the 2nd element
-        # is a list containing the individual satisfactions
+        if landmark_influence is None:
+            landmark_influence = int(any(n.landmark and self.religion.preference(n.religion) for n in neighbors))
+        if landmark_influence > 0:
+            satisfactions[0] = np.fmax(satisfactions[0], landmark_influence)
+
+        # The weighted average, without the overhead of np.average for a few numbers
+        self.satisfaction = sum(weight * satisfaction for weight, satisfaction in zip(weights, satisfactions)) \
+            / sum(weights)
         return self.satisfaction
 
     def __str__(self):
@@ -131,10 +135,12 @@ class Agent:
 
 
 if __name__ == "__main__":
-    agent_list = [Agent(religion=CategoricalFeature(value=random.choice(list(Religion)),
+    rng = np.random.default_rng()
+    agent_list = [Agent(religion=CategoricalFeature(value=rng.choice(list(Religion)),
                                                     preference_matrix=religion_preference_matrix),
-                        ethnicity=BinaryFeature(value=random.choice([True, False])),
-                        income=RealNumberFeature(value=random.randint(0, 100), threshold=20)) for _ in range(0, 100)]
+                        ethnicity=BinaryFeature(value=bool(rng.integers(2))),
+                        income=RealNumberFeature(value=int(rng.integers(0, 100, endpoint=True)), threshold=20))
+                  for _ in range(0, 100)]
     print([str(x) for x in agent_list])
     sys.stdout = open("out/out.csv", "w")
     for index, agent in enumerate(agent_list[1:]):
@@ -0,0 +1,127 @@
+import numpy as np
+
+from landmark import LandmarkIndex
+from params import neighborhood_shape, radius as default_radius
+from satisfaction import prospect_satisfaction, religion_threshold, satisfaction_grid
+
+# How the unsatisfied agents of a step are moved
+SEQUENTIAL = "sequential"  # one at a time in grid order, each seeing the moves before it (city.time_step)
+SYNCHRONOUS = "synchronous"  # all at once, everyone decides on the city as it was at the start of the step
+RANDOM_SEQUENTIAL = "random_sequential"  # in random order, a batch at a time, each batch sees the ones before it
+
+
+def _group_starts(groups, count):
+    """Where each group starts in a sorted array of group numbers, with the end as a last element"""
+    return np.searchsorted(groups, np.arange(count + 1))
+
+
+def match_vacancies(city, movers, vacant, rng, radius=default_radius, weights=None, weighted=False,
+                    kind=neighborhood_shape, check_future_home=False, proposals=10, prospect=None, landmarks=None):
+    """Assign unsatisfied agents to empty homes, at most one agent per home. If the city's layers have
+    leading axes (several cities), agents only move to homes in their own city
+    :param movers: flat indices of the agents' homes, in the order they get to choose
+    :param vacant: flat indices of the empty homes, sorted
+    :param check_future_home: only move an agent to a home it would be satisfied in. Every agent that is
+    left proposes a random remaining home in each round, the first agent to propose an acceptable home
+    gets it
+    :param proposals: number of rounds of proposals when checking the future home
+    :param prospect: function of (movers, homes) that returns the satisfaction each agent would have in
+    the home, satisfaction.prospect_satisfaction on the city by default
+    :param landmarks: LandmarkIndex of the city for the default prospect, built here if None
+    :return (sources, targets) flat indices of the moves"""
+    cells = city.shape[-2] * city.shape[-1]
+    cities = city.empty.size // cells
+    if not check_future_home:
+        # In every city the first agents get a random sample of the homes, as many as there are of either
+        movers = movers[np.argsort(movers // cells, kind="stable")]
+        vacant = vacant[np.lexsort((rng.random(len(vacant)), vacant // cells))]
+        mover_groups, vacant_groups = movers // cells, vacant // cells
+        mover_starts, vacant_starts = _group_starts(mover_groups, cities), _group_starts(vacant_groups, cities)
+        moves = np.minimum(np.diff(mover_starts), np.diff(vacant_starts))
+        first_movers = np.arange(len(movers)) - mover_starts[mover_groups] < moves[mover_groups]
+        first_vacant = np.arange(len(vacant)) - vacant_starts[vacant_groups] < moves[vacant_groups]
+        return movers[first_movers], vacant[first_vacant]
+    if prospect is None:
+        if landmarks is None:
+            landmarks = LandmarkIndex.from_city(city, radius, kind, threshold=religion_threshold)
+
+        def prospect(movers, homes):
+            return prospect_satisfaction(city, movers, homes, radius, weights, weighted, kind, landmarks)
+
+    sources = []
+    targets = []
+    for _ in range(proposals):
+        groups = movers // cells
+        starts = _group_starts(vacant // cells, cities)
+        available = starts[groups + 1] - starts[groups]
+        proposing = np.flatnonzero(available > 0)
+        if not len(proposing):
+            break
+        proposed = vacant[starts[groups[proposing]]
+                          + (rng.random(len(proposing)) * available[proposing]).astype(np.intp)]
+        acceptable = np.flatnonzero(prospect(movers[proposing], proposed) > 0.5)
+        # A home proposed by several agents goes to the first one
+        homes, first = np.unique(proposed[acceptable], return_index=True)
+        chosen = proposing[acceptable[first]]
+        sources.append(movers[chosen])
+        targets.append(homes)
+        movers = np.delete(movers, chosen)
+        vacant = np.setdiff1d(vacant, homes, assume_unique=True)
+    if not sources:
+        return movers[:0], vacant[:0]
+    return np.concatenate(sources), np.concatenate(targets)
+
+
+def batch_time_step(city, rng, radius=default_radius, weights=None, weighted=False, kind=neighborhood_shape,
+                    mode=SYNCHRONOUS, batches=10, check_future_home=False, proposals=10, observers=(),
+                    satisfied=None, prospect=None, landmarks=None):
+    """Make one time step pass on a CityArrays with array operations instead of visiting agents one by one.
+    The satisfaction of all agents is computed at once, and the unsatisfied ones are matched to empty homes
+    in one assignment, so no two of them pick the same home.
+    :param city: CityArrays, changed in place
+    :param rng: numpy random Generator
+    :param mode: SYNCHRONOUS to move all unsatisfied agents together, or RANDOM_SEQUENTIAL to move them in
+    random order, split into batches. Satisfaction is computed again before every batch, so agents that
+    became satisfied stay, and homes left by earlier batches can be taken
+    :param batches: number of batches of a RANDOM_SEQUENTIAL step
+    :param check_future_home: only move agents to homes they would be satisfied in, see match_vacancies
+    :param observers: objects with a move(src, dst) method that are told about every move, with (x, y) homes
+    :param satisfied: function that returns which cells hold a satisfied agent, as a flat boolean array.
+    By default computed with satisfaction.satisfaction_grid, tiled.TiledCity passes one that runs in parallel
+    :param prospect: passed on to match_vacancies
+    :param landmarks: LandmarkIndex of the city, built once for the step if None
+    :return ratio of agents that were satisfied at the start of the step. If the layers have leading axes
+    (several cities, see ensemble.py), an array with the ratio of every city"""
+    if mode not in (SYNCHRONOUS, RANDOM_SEQUENTIAL):
+        raise ValueError(f"Unknown update mode {mode!r}")
+    if landmarks is None and (satisfied is None or prospect is None and check_future_home):
+        # Landmarks don't move, their index holds for every batch
+        landmarks = LandmarkIndex.from_city(city, radius, kind, threshold=religion_threshold)
+    if satisfied is None:
+        def satisfied():
+            return (satisfaction_grid(city, radius, weights, weighted, kind, landmarks)[0] > 0.5).ravel()
+    agents = city.occupied.ravel()
+    happy = satisfied()
+    cells = city.shape[-2] * city.shape[-1]
+    satisfied_ratio = (happy & agents).reshape(-1, cells).sum(axis=1) / agents.reshape(-1, cells).sum(axis=1)
+    satisfied_ratio = satisfied_ratio.reshape(city.shape[:-2]) if city.empty.ndim > 2 else satisfied_ratio[0]
+    movers = rng.permutation(np.flatnonzero(agents & ~happy))
+    parts = [movers] if mode == SYNCHRONOUS else np.array_split(movers, min(batches, max(len(movers), 1)))
+
+    for k, batch in enumerate(parts):
+        if k > 0:
+            batch = batch[~satisfied()[batch]]
+        sources, targets = match_vacancies(city, batch, np.flatnonzero(city.empty), rng, radius, weights,
+                                           weighted, kind, check_future_home, proposals, prospect, landmarks)
+        # Sources hold agents and targets are empty, so the moves don't depend on each other's order
+        src = np.unravel_index(sources, city.shape)
+        dst = np.unravel_index(targets, city.shape)
+        for name in city.agent_layers:
+            getattr(city, name)[dst] = getattr(city, name)[src]
+        city.empty[src] = True
+        city.empty[dst] = False
+        if observers:
+            for move in zip(zip(*(axis.tolist() for axis in src)), zip(*(axis.tolist() for axis in dst))):
+                for observer in observers:
+                    observer.move(*move)
+    return satisfied_ratio
@@ -0,0 +1,247 @@
+"""Time the hot paths of the simulation over a matrix of grid sizes, radii and weights, with fixed seeds.
+
+Every benchmark is run on a freshly generated city of each size. The results are written as JSON: the
+seconds per call, calls per second (steps per second for time_step) and the peak memory allocated during
+one call. Given an earlier results file as baseline, every result is compared to the matching one in it,
+and the exit status is 1 if anything got slower by more than the tolerance.
+
+With --object-models, the memory taken by the object grid of each size and the time to read every
+agent's features are also measured, for grids of the usual classes and of the compact ones of compact.py.
+
+Usage: python benchmark.py --out bench.json
+       python benchmark.py --sizes 16 64 --out new.json --baseline bench.json --tolerance 0.2
+       python benchmark.py --sizes 256 1024 --only get_frame --object-models"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import compact
+from city import generate_city, get_frame, neighbors, time_step
+from cluster_counts import cluster_religion, income_comparison
+from generation import generate_city_arrays
+from params import weight_list
+from satisfaction import SatisfactionCache
+from vacancies import VacancyIndex
+
+sizes = (16, 64, 256, 1024)
+radii = (1, 2)
+weight_settings = ([1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 1])
+# neighbors and Agent.satisfied are timed on this many agents picked at random, one call each
+sampled_agents = 1000
+
+
+def _agent_cells(city, rng):
+    """A random sample of the houses that hold an agent"""
+    occupied = [cell for cell, house in np.ndenumerate(city) if not (house.empty or house.landmark)]
+    picks = rng.choice(len(occupied), size=min(sampled_agents, len(occupied)), replace=False)
+    return [occupied[k] for k in picks]
+
+
+def bench_time_step(city, radius, weights, rng):
+    vacancies = VacancyIndex.from_city(city)
+    cache = SatisfactionCache(city, radius=radius, weights=weights)
+    steps = iter(range(sys.maxsize))
+
+    def step():
+        time_step(next(steps), city, vacancies, cache=cache, rng=rng, radius=radius, verbose=False)
+    return step, 1
+
+
+def bench_time_step_default(city, radius, weights, rng, cached=True):
+    """time_step as the simulation runs it, with every setting from params.py"""
+    vacancies = VacancyIndex.from_city(city)
+    cache = SatisfactionCache(city) if cached else None
+    steps = iter(range(sys.maxsize))
+
+    def step():
+        time_step(next(steps), city, vacancies, cache=cache, rng=rng, verbose=False)
+    return step, 1
+
+
+def bench_time_step_uncached(city, radius, weights, rng):
+    return bench_time_step_default(city, radius, weights, rng, cached=False)
+
+
+def bench_neighbors(city, radius, weights, rng):
+    cells = _agent_cells(city, rng)
+
+    def look_around():
+        for x, y in cells:
+            neighbors(city, radius, x, y, city[x, y].occupant)
+    return look_around, len(cells)
+
+
+def bench_satisfied(city, radius, weights, rng):
+    agents = [(city[x, y].occupant, neighbors(city, radius, x, y, city[x, y].occupant))
+              for x, y in _agent_cells(city, rng)]
+
+    def satisfy():
+        for agent, house_neighbors in agents:
+            agent.satisfied(house_neighbors)
+    return satisfy, len(agents)
+
+
+def bench_cluster_religion(city, radius, weights, rng):
+    return lambda: cluster_religion(city), 1
+
+
+def bench_income_comparison(city, radius, weights, rng):
+    return lambda: income_comparison(city), 1
+
+
+def bench_get_frame(city, radius, weights, rng):
+    return lambda: get_frame(city), 1
+
+
+# Name, function that sets up the benchmark and returns (function to time, calls it makes), and whether
+# the result depends on the radius and weights. Those that don't are only run once per grid size, on a city
+# whose agents have the weights of params.py.
+benchmarks = (("time_step", bench_time_step, True),
+              ("time_step_default", bench_time_step_default, False),
+              ("time_step_uncached", bench_time_step_uncached, False),
+              ("neighbors", bench_neighbors, True),
+              ("satisfied", bench_satisfied, True),
+              ("cluster_religion", bench_cluster_religion, False),
+              ("income_comparison", bench_income_comparison, False),
+              ("get_frame", bench_get_frame, False))
+
+
+def measure(function, min_time=0.5, max_runs=50):
+    """Run a function until it has taken min_time in total (at least once, at most max_runs times), then
+    once more with tracemalloc on
+    :return tuple of the duration of every run and the peak memory allocated by the last run, in bytes"""
+    durations = []
+    while not durations or (sum(durations) < min_time and len(durations) < max_runs):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return durations, peak
+
+
+def run_benchmarks(sizes=sizes, radii=radii, weight_settings=weight_settings, names=None, seed=0, min_time=0.5,
+                   log=print):
+    """Run every benchmark on every combination of settings
+    :param names: names of the benchmarks to run, all if None
+    :param seed: the city and all random choices of a combination come from a generator with this seed
+    :param log: called with a line of text after every result
+    :return list of result dicts"""
+    results = []
+    for size in sizes:
+        for name, setup, configurable in benchmarks:
+            if names is not None and name not in names:
+                continue
+            settings = [(radius, weights) for radius in radii for weights in weight_settings] if configurable \
+                else [(None, None)]
+            for radius, weights in settings:
+                rng = np.random.default_rng(seed)
+                city = generate_city(w=size, h=size, weights=weights or weight_list, method="vectorized", rng=rng)
+                function, calls = setup(city, radius or 1, weights or weight_list, rng)
+                durations, peak = measure(function, min_time)
+                per_call = np.array(durations) / calls
+                results.append({"benchmark": name, "size": size, "radius": radius, "weights": weights,
+                                "runs": len(durations), "calls": calls * len(durations),
+                                "seconds_per_call": float(per_call.mean()),
+                                "min_seconds_per_call": float(per_call.min()),
+                                "calls_per_second": float(1 / per_call.mean()),
+                                "peak_memory_bytes": peak})
+                log(f"{name:18} size {size:5} radius {radius} weights {weights}: "
+                    f"{per_call.mean() * 1e3:.4f} ms per call, peak {peak / 2 ** 20:.1f} MiB")
+    return results
+
+
+def _read_features(grid):
+    """Read every feature of every agent of an object grid, like the object-model code does"""
+    total = 0
+    for house in grid.flat:
+        if not (house.empty or house.landmark):
+            agent = house.occupant
+            total += agent.religion.value + agent.ethnicity.value + agent.income.value
+    return total
+
+
+def object_model_memory(sizes=sizes, seed=0, min_time=0.5, log=print):
+    """Compare object grids built from the usual classes and from the compact ones, on the same cities
+    :return list of result dicts with the memory the grid takes and the seconds to read all features"""
+    results = []
+    for size in sizes:
+        city = generate_city_arrays(size, size, weight_settings[0], rng=np.random.default_rng(seed))
+        houses = city.empty.size
+        for model in ("default", "compact"):
+            # Count the shared features of this grid only
+            compact.pool.clear()
+            tracemalloc.start()
+            grid = city.to_object_grid(model == "compact")
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            durations, _ = measure(lambda: _read_features(grid), min_time)
+            results.append({"benchmark": "object_memory", "size": size, "model": model,
+                            "memory_bytes": memory, "bytes_per_house": memory / houses,
+                            "read_seconds": float(min(durations)), "shared_features": len(compact.pool)})
+            log(f"object grid {model:8} size {size:5}: {memory / 2 ** 20:.1f} MiB ({memory / houses:.0f} B per "
+                f"house), reading all features {min(durations) * 1e3:.1f} ms")
+            del grid
+    return results
+
+
+def _result_key(result):
+    return result["benchmark"], result["size"], result["radius"], json.dumps(result["weights"])
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare results to the matching ones of a baseline, results without a match are left out
+    :param tolerance: how much slower than the baseline a result may be before it counts as a regression
+    :return list of (result, baseline result, ratio of their fastest seconds per call, whether it is a
+    regression). The fastest call is compared since it is the least disturbed by other load on the machine"""
+    previous = {_result_key(result): result for result in baseline}
+    comparison = []
+    for result in results:
+        old = previous.get(_result_key(result))
+        if old is None:
+            continue
+        ratio = result["min_seconds_per_call"] / old["min_seconds_per_call"]
+        comparison.append((result, old, ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the simulation and compare with a baseline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=sizes, help="widths (and heights) of the grids")
+    parser.add_argument("--radii", type=int, nargs="+", default=radii)
+    parser.add_argument("--weights", type=json.loads, nargs="+", default=weight_settings,
+                        help="weight lists as JSON, e.g. [1,0,0]")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _, _ in benchmarks],
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to repeat each benchmark for")
+    parser.add_argument("--out", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown relative to the baseline")
+    parser.add_argument("--object-models", action="store_true",
+                        help="also compare the memory of object grids of the usual and the compact classes")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.radii, args.weights, args.only, args.seed, args.min_time)
+    object_models = object_model_memory(args.sizes, args.seed, args.min_time) if args.object_models else []
+    with open(args.out, "w") as file:
+        json.dump({"machine": {"python": platform.python_version(), "numpy": np.__version__,
+                               "platform": platform.platform(), "processor": platform.processor()},
+                   "seed": args.seed, "results": results, "object_models": object_models}, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = 0
+        for result, old, ratio, regression in compare(results, baseline, args.tolerance):
+            regressions += regression
+            print(f"{'SLOWER' if regression else 'ok':6} {result['benchmark']:18} size {result['size']:5} "
+                  f"radius {result['radius']} weights {result['weights']}: {ratio:.2f}x baseline")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,92 @@
+import json
+
+import numpy as np
+
+from city_arrays import CityArrays
+from features import extra_features
+from vacancies import VacancyIndex
+
+
+class Checkpoint:
+    """The state of a simulation at the start of a time step, as read back by load_checkpoint"""
+
+    def __init__(self, city, iteration, vacancies, rng, income_sum, histories, frame_offsets, prospects,
+                 feature_sums=None):
+        self.city = city
+        self.iteration = iteration
+        self.vacancies = vacancies
+        self.rng = rng
+        self.income_sum = income_sum
+        self.histories = histories
+        self.frame_offsets = frame_offsets
+        self.prospects = prospects
+        self.feature_sums = feature_sums
+
+
+def save_checkpoint(path, city, iteration, vacancies, rng, cache=None, histories=None, frame_offsets=None,
+                    prospects=None):
+    """Write everything needed to continue a run exactly where it is to one compressed .npz file: the grid
+    layers, the state of the random generator, the order of the vacancy index (it decides which house a random
+    move picks), the running income (and registered feature) sums of the satisfaction cache and the metric
+    histories so far.
+    :param path: file to write
+    :param city: object grid or CityArrays
+    :param iteration: number of the time step that is about to run
+    :param vacancies: the VacancyIndex used by time_step
+    :param rng: the numpy random Generator of the run
+    :param cache: the SatisfactionCache used by time_step, if any
+    :param histories: dict of name to list of per-step values
+    :param frame_offsets: dict of gif name to the size of the gif file so far, to cut off later frames
+    :param prospects: the ProspectIndex used by time_step, if any, its order decides which house is picked"""
+    if not isinstance(city, CityArrays):
+        city = CityArrays.from_object_grid(city)
+    layers = dict(religion=city.religion, ethnicity=np.packbits(city.ethnicity), income=city.income,
+                  price=city.price, occupied=city.packed_occupancy(), landmark=np.packbits(city.landmark),
+                  shape=np.array(city.shape), weights=np.array(city.weights, dtype=float),
+                  preference_matrix=city.preference_matrix)
+    layers.update({"feature_" + feature.name: getattr(city, feature.name) for feature in extra_features()})
+    extra = {"history_" + name: np.asarray(values) for name, values in (histories or {}).items()}
+    extra.update({"frames_" + name: np.array(offset) for name, offset in (frame_offsets or {}).items()})
+    if cache is not None:
+        extra["income_sum"] = cache.income_sum
+        extra.update({"sums_" + name: sums for name, sums in cache.feature_sums.items()})
+    if prospects is not None:
+        extra.update({f"prospects_{religion}_{ethnicity}": np.array(index.cells, dtype=np.int64).reshape(-1, 2)
+                      for (religion, ethnicity), index in prospects.members.items()})
+    np.savez_compressed(path, iteration=np.array(iteration),
+                        vacancies=np.array(vacancies.cells, dtype=np.int64).reshape(-1, 2),
+                        random_state=np.array(json.dumps(rng.bit_generator.state)),
+                        **layers, **extra)
+
+
+def load_checkpoint(path):
+    """Read a checkpoint written by save_checkpoint
+    :return Checkpoint, its rng continues where the saved one was"""
+    with np.load(path) as data:
+        shape = tuple(data["shape"])
+        size = int(np.prod(shape))
+        city = CityArrays(shape, preference_matrix=data["preference_matrix"], weights=data["weights"].tolist())
+        city.religion[...] = data["religion"]
+        city.ethnicity[...] = np.unpackbits(data["ethnicity"], count=size).reshape(shape)
+        city.income[...] = data["income"]
+        city.price[...] = data["price"]
+        city.landmark[...] = np.unpackbits(data["landmark"], count=size).reshape(shape)
+        city.set_packed_occupancy(data["occupied"])
+        for feature in extra_features():
+            if "feature_" + feature.name in data.files:
+                getattr(city, feature.name)[...] = data["feature_" + feature.name]
+        vacancies = VacancyIndex(map(tuple, data["vacancies"].tolist()))
+        histories = {name[len("history_"):]: data[name].tolist() for name in data.files
+                     if name.startswith("history_")}
+        frame_offsets = {name[len("frames_"):]: int(data[name]) for name in data.files
+                         if name.startswith("frames_")}
+        income_sum = data["income_sum"] if "income_sum" in data.files else None
+        feature_sums = {name[len("sums_"):]: data[name] for name in data.files
+                        if name.startswith("sums_")}
+        prospects = {tuple(int(part) for part in name.split("_")[1:]): data[name].tolist() for name in data.files
+                     if name.startswith("prospects_")} or None
+        state = json.loads(str(data["random_state"]))
+        rng = np.random.Generator(getattr(np.random, state["bit_generator"])())
+        rng.bit_generator.state = state
+        return Checkpoint(city, int(data["iteration"]), vacancies, rng, income_sum, histories, frame_offsets,
+                          prospects, feature_sums)
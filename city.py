@@ -1,60 +1,87 @@
-import colorsys
+import argparse
 import os
-import random
 import matplotlib
-matplotlib.use('TkAgg')
+# Plots are only saved to files, so no display is needed
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 
-from agent import Agent, RealNumberFeature, BinaryFeature, CategoricalFeature, religion_preference_matrix
-from home import Home
-from landmark import Landmark, CategoricalFeature, religion_preference_matrix
+from agent import religion_preference_matrix
 from params import *
-from cluster_counts import cluster_religion, cluster_ethnicity, income_comparison
-
-
-def neighbors(a, radius, rowNumber, columnNumber, agent):
+from batch_update import SEQUENTIAL, batch_time_step
+from checkpoint import load_checkpoint, save_checkpoint
+from city_arrays import CityArrays
+from cluster_counts import ClusterTracker, cluster_religion, cluster_ethnicity, income_comparison
+from compact import object_model
+from features import extra_features
+from frame_writer import GifStreamWriter
+from generation import generate_city_arrays
+from instrumentation import Instrumentation
+from metrics import Metric, MetricsScheduler
+from neighborhood import neighbor_table
+from prospects import ProspectIndex
+from render import render_frames
+from satisfaction import SatisfactionCache
+from trajectory import TrajectoryRecorder
+from vacancies import VacancyIndex
+
+
+def neighbors(a, radius, rowNumber, columnNumber, agent, kind=neighborhood_shape):
     """Get a list of all the neighbors
     :param a: city matrix
-    :param radius: maximum chebyshev distance to check
+    :param radius: maximum distance to check
     :param rowNumber: current row number of house
     :param columnNumber: current column number of house
     :param agent: agent living in house
+    :param kind: shape of the neighborhood, "moore" (chebyshev distance) or "von_neumann" (manhattan distance)
     :return a list containing the neighbor agent objects"""
-    house_neighbors = []
-
-    # Add any neighbors in range thar are not the agent itself.
-    for i in range(rowNumber - radius, rowNumber + radius + 1):
-        for j in range(columnNumber - radius, columnNumber + radius + 1):
-            if 0 <= i < len(a) and 0 <= j < len(a[0]):
-                if not a[i][j].empty and a[i][j].occupant != agent:
-                    house_neighbors.append(a[i][j].occupant)
-    return house_neighbors
+    return _table_neighbors(a, radius, rowNumber, columnNumber, agent, False, kind)
 
 
-def neighbors_weighted(a, radius, rowNumber, columnNumber, agent):
+def neighbors_weighted(a, radius, rowNumber, columnNumber, agent, kind=neighborhood_shape):
     """Closer neighbors are more important (counted multiple times)
     :param a: city matrix
-    :param radius: maximum chebyshev distance to check
+    :param radius: maximum distance to check
     :param rowNumber: current row number of house
     :param columnNumber: current column number of house
     :param agent: agent living in house
+    :param kind: shape of the neighborhood, "moore" (chebyshev distance) or "von_neumann" (manhattan distance)
     :return a list containing the neighbor agent objects"""
+    return _table_neighbors(a, radius, rowNumber, columnNumber, agent, True, kind)
+
+
+def _table_neighbors(a, radius, rowNumber, columnNumber, agent, weighted, kind):
+    """Look up the neighbors of a house in the precomputed neighbor table of the grid"""
+    indptr, indices = neighbor_table(a.shape, radius, weighted, kind)
+    cell = rowNumber * a.shape[1] + columnNumber
+    houses = a.ravel()
     house_neighbors = []
 
     # Add any neighbors in range that are not the agent itself.
-    for r in range(1, radius + 1):
-        for i in range(rowNumber - r, rowNumber + r + 1):
-            for j in range(columnNumber - r, columnNumber + r + 1):
-                if 0 <= i < len(a) and 0 <= j < len(a[0]):
-                    if not a[i][j].empty and a[i][j].occupant != agent:
-                        house_neighbors.append(a[i][j].occupant)
+    for k in indices[indptr[cell]:indptr[cell + 1]]:
+        house = houses[k]
+        if not house.empty and house.occupant != agent:
+            house_neighbors.append(house.occupant)
     return house_neighbors
 
 
-def generate_city():
-    """Generate a random city grid based on the parameters"""
+def generate_city(w=w, h=h, weights=weight_list, empty_ratio=empty_ratio, landmark_ratio=landmark_ratio,
+                  min_price=min_price, max_price=max_price, price_noise=price_noise,
+                  price_segregation=price_segregation, min_income=min_income, max_income=max_income,
+                  method="reference", rng=None, compact=False):
+    """Generate a random city grid based on the parameters, which default to the ones in params.py
+    :param method: "reference" to generate it house by house, or "vectorized" to generate it with array
+    operations (generation.generate_city_arrays) and build the grid from that
+    :param rng: numpy random Generator to draw from, a new unseeded one if None
+    :param compact: build the grid from the slotted classes with shared features of compact.py"""
+    if rng is None:
+        rng = np.random.default_rng()
+    if method != "reference":
+        return generate_city_arrays(w, h, weights, empty_ratio, landmark_ratio, min_price, max_price, price_noise,
+                                    price_segregation, min_income, max_income, method,
+                                    rng).to_object_grid(compact)
+    model = object_model(compact)
     # City is a matrix with a padding
     grid = np.zeros((w + 2, h + 2), dtype=object)
     for x in range(-2, w + 2):
@@ -62,13 +89,13 @@ def generate_city():
             # These are 2 rows/columns that will not show in the bitmap,
             # but we will use them to generate the first row/column
             if x < 0 or y < 0 or x >= w or y >= h:
-                price = random.randint(min_price, max_price)
+                price = rng.integers(min_price, max_price, endpoint=True)
             # Average some neighboring houses then add noise
             else:
                 price = np.average([grid[x][y - 1].price, grid[x][y - 2].price,
                                     grid[x - 1][y].price, grid[x - 2][y].price,
                                     grid[x - 1][y + 1].price, grid[x - 2][y + 1].price])
-                price = price + random.randint(-price_noise * max_price, price_noise * max_price)
+                price = price + rng.integers(int(-price_noise * max_price), int(price_noise * max_price), endpoint=True)
 
                 # Noise may have made price above max, limit it to the [0, max_price] interval
                 if price > max_price:
@@ -84,217 +111,311 @@ def generate_city():
                 price = (price + max_price * price_segregation) / (1 + price_segregation)
 
             # 1 in 10 probability of an empty house, 1 in 100 for a landmark. Landmark takes priority over empty
-            empty = random.randint(1, 1 / empty_ratio) == 1
-            landmark = random.randint(1, 1 / landmark_ratio) == 1
+            empty = rng.integers(1, round(1 / empty_ratio), endpoint=True) == 1
+            landmark = rng.integers(1, round(1 / landmark_ratio), endpoint=True) == 1
             if landmark:
                 empty = 0
 
             # If both empty and landmark are false, make an agent
             if not empty or not landmark:
                 # Creating a random agent that lives in that home
-                eth = (random.randint(1, 2) == 1)
-                a = Agent(religion=CategoricalFeature(value=random.randint(1, 5),
-                                                      preference_matrix=religion_preference_matrix),
-                          ethnicity=BinaryFeature(value=eth),
-                          income=RealNumberFeature(value=random.randint(min_income, max_income), threshold=30000),
-                          landmark=0,
-                          weights=weight_list)
+                eth = bool(rng.integers(1, 2, endpoint=True) == 1)
+                a = model.agent(religion=model.categorical(value=int(rng.integers(1, 5, endpoint=True)),
+                                                           preference_matrix=religion_preference_matrix),
+                                ethnicity=model.binary(value=eth),
+                                income=model.real(value=int(rng.integers(min_income, max_income, endpoint=True)),
+                                                  threshold=30000),
+                                landmark=0,
+                                weights=weights,
+                                **{feature.name: model.wrap(feature, feature.random(rng, ()))
+                                   for feature in extra_features()})
             # If empty is true, make the space empty
             elif empty:
                 a = None
             # Lastly if not empty and landmark is true, make a landmark of a random religion
             if landmark:
-                a = Landmark(religion=CategoricalFeature(value=random.randint(1, 5),
-                                                         preference_matrix=religion_preference_matrix),
-                             landmark=1)
+                a = model.landmark(religion=model.categorical(value=int(rng.integers(1, 5, endpoint=True)),
+                                                              preference_matrix=religion_preference_matrix),
+                                   landmark=1)
 
             # Generating a home with a price depending on its location
-            grid[x][y] = Home(price=price, empty=empty, landmark=landmark, occupant=a)
+            grid[x][y] = model.home(price=price, empty=empty, landmark=landmark, occupant=a)
     return grid
 
 
-def time_step(i):
+def _influence(landmarks, agent, x, y):
+    """The influence of landmarks on an agent living at (x, y), None to let the agent scan its neighbors"""
+    return None if landmarks is None else landmarks.influence(agent.religion.value, x, y)
+
+
+def time_step(i, city, vacancies=None, observers=(), cache=None, rng=None, radius=radius,
+              check_future_home=check_future_home, kind=neighborhood_shape, verbose=True, prospects=None,
+              landmarks=None, scan_ratio=cache_scan_ratio):
     """Makes one time step (epoch) pass
     :param i: the number of the time step
+    :param city: the city grid
+    :param vacancies: VacancyIndex of the empty houses of the city, kept up to date as agents move.
+    If None, one is built for this step
+    :param observers: objects with a move(src, dst) method that are told about every move, e.g. ClusterTrackers
+    :param cache: SatisfactionCache of the city. If given, only the agents it knows to be unsatisfied are
+    visited and their satisfaction is read from it instead of being recomputed. While many agents are
+    unsatisfied, every agent is visited instead and the cache is rebuilt after the step, see scan_ratio
+    :param rng: numpy random Generator that picks the houses agents move to, a new unseeded one if None
+    :param radius: maximum distance at which agents look at neighbors
+    :param check_future_home: whether agents only move to a house they would be satisfied in
+    :param kind: shape of the neighborhood, "moore" or "von_neumann"
+    :param verbose: print the step number every other step
+    :param prospects: ProspectIndex over the cache. If given, agents that check their future home move to a
+    uniformly random house they would be satisfied in, instead of the first one found
+    :param landmarks: LandmarkIndex of the city that agents look up the influence of landmarks in when there is
+    no cache, instead of scanning their neighbors for landmarks
+    :param scan_ratio: with a cache and no prospects, visit every agent if more than this ratio of them is
+    unsatisfied. Updating the cache costs more per move than visiting an agent, so it only pays off when
+    few agents move
     :return ratio of agents that are satisfied at the end of the time step"""
     # A print showing the progress of the iterations, helpful to see progress is being made while simulating.
-    if i % 2 == 0:
+    if verbose and i % 2 == 0:
         print(i)
 
+    if vacancies is None:
+        vacancies = VacancyIndex.from_city(city)
+    if rng is None:
+        rng = np.random.default_rng()
+
+    stale = None
+    if cache is not None and prospects is None and len(cache.unsatisfied) > scan_ratio * cache.agent_count:
+        # The moves are made the same way without the cache, which is brought up to date once at the end
+        stale, cache = cache, None
+        if landmarks is None:
+            landmarks = stale.landmarks
+    if cache is None:
+        # Go through the entire city to check whether occupants are satisfied
+        cells = (cell for cell, house in np.ndenumerate(city))
+    else:
+        cells = cache.scan()
+    # The random numbers of the whole step are drawn at once, one for every house, so the same agents make the
+    # same moves whether or not the cache is used
+    draws = rng.random(city.size)
+
     city_satisfactions = []
-    # Go through the entire city to check whether occupants are satisfied
-    for (x, y), house in np.ndenumerate(city):
+    for x, y in cells:
+        k = x * city.shape[1] + y
+        house = city[x, y]
         # Skip edge for now
         if not (house.empty or house.landmark):
             agent = house.occupant
-            house_neighbors = neighbors(city, radius, x, y, agent)
-            satisfaction = agent.satisfied(house_neighbors)
-            city_satisfactions.append(int(satisfaction > 0.5))
+            if cache is None:
+                house_neighbors = neighbors(city, radius, x, y, agent, kind)
+                satisfaction = agent.satisfied(house_neighbors, _influence(landmarks, agent, x, y))
+                city_satisfactions.append(int(satisfaction > 0.5))
+            else:
+                satisfaction = cache.satisfaction[x, y]
             # If the agent is not satisfied with their current position, try to move
             if not satisfaction > 0.5:
                 # Move the agent to a random empty house that they are satisfied with
-                # first build a list of prospects
-                prospects = []
-                # Move as soon as prospect is filled
-                for (xm, ym), housem in np.ndenumerate(city):
-                    if housem.empty:
-                        # In some cases we want them to not check the future home, and move randomly
-                        if not check_future_home:
-                            prospects.append((xm, ym))
+                target = None
+                # In some cases we want them to not check the future home, and move randomly
+                if not check_future_home:
+                    if vacancies:
+                        target = vacancies.at(draws[k])
+                elif prospects is not None:
+                    target = prospects.sample((x, y), rng)
+                else:
+                    # Move as soon as a satisfying prospect is found
+                    for xm, ym in vacancies:
+                        if cache is None:
+                            p_house_neighbors = neighbors(city, radius, xm, ym, agent, kind)
+                            prospect_satisfaction = agent.satisfied(p_house_neighbors,
+                                                                    _influence(landmarks, agent, xm, ym))
                         else:
-                            # checking if prospect is satisfying
-                            p_house_neighbors = neighbors(city, radius, xm, ym, agent)
-                            if agent.satisfied(p_house_neighbors) > 0.5:
-                                prospects.append((xm, ym))
-                                break
-                if prospects:  # if list is not empty, move to a random element
-                    target_house = city[random.choice(prospects)]
+                            prospect_satisfaction = cache.prospect((x, y), (xm, ym))
+                        if prospect_satisfaction > 0.5:
+                            target = (xm, ym)
+                            break
+                if target is not None:
+                    target_house = city[target]
                     target_house.occupant = house.occupant
                     target_house.empty = False
                     house.occupant = None
                     house.empty = True
-
+                    vacancies.move((x, y), target)
+                    if cache is not None:
+                        cache.move((x, y), target)
+                    if prospects is not None:
+                        prospects.move((x, y), target)
+                    for observer in observers:
+                        observer.move((x, y), target)
+
+    if stale is not None:
+        stale.rebuild(city)
+        return stale.satisfied_ratio()
+    if cache is not None:
+        return cache.satisfied_ratio()
     return np.average(city_satisfactions)
 
 
+class GridMover:
+    """Makes the moves of batch_update.batch_time_step, which works on a CityArrays, in the object grid too"""
+
+    def __init__(self, city):
+        self.city = city
+
+    def move(self, src, dst):
+        house, target_house = self.city[src], self.city[dst]
+        target_house.occupant = house.occupant
+        target_house.empty = False
+        house.occupant = None
+        house.empty = True
+
+
 def get_frame(city):
     """Draw the city
     :param city: the city grid
     :return tuple of religion, ethnicity and income images"""
-    data = np.zeros((h + 1, w + 1, 3), dtype=np.uint8)
-
-    # Plot incomes
-    for (x, y), house in np.ndenumerate(city):
-        if x > w or y > h:
-            continue
-        if not (house.empty or house.landmark):
-            # equation of a line through 2 points (min_income, 0) and (max_income,255)
-            color = int((house.occupant.income.value - min_income) * 255 / (max_income - min_income))
-            plt.scatter(x, y, c='#%02x%02x%02x' % (255, color, 255),s=100)
-            data[x][y] = [color, 255, color]
-        elif house.landmark:
-            # Make landmarks green on the income map
-            plt.scatter(x,y,c="green",s=100,marker="^")
-        else:
-            # Show Empty spaces as black on the income map
-            plt.scatter(x,y,c="black",s=100)
-
-    plt.gca().set_aspect('equal', adjustable='box')
-    plt.axis("off")
-
-    canvas = plt.get_current_fig_manager().canvas
-    canvas.draw()
-    img_income = Image.frombytes('RGB', canvas.get_width_height(), canvas.tostring_rgb())
-
-    # Plot ethnicities
-    for (x, y), house in np.ndenumerate(city):
-        if x > w or y > h:
-            continue
-        if not (house.empty or house.landmark):
-            # Since ethnicity is binary for now, add fixed colors red and blue based on ethnicity value
-            if house.occupant.ethnicity.value:
-                plt.scatter(x, y, c="red",s=100)
-            else:
-                plt.scatter(x,y,c="blue",s=100)
-        elif house.landmark:
-            # Make landmarks green on the ethnicity map
-            plt.scatter(x,y,c="green",s=100,marker="^")
-        else:
-            # Show empty spaces as black on the ethnicity map
-            plt.scatter(x,y,c="black",s=100)
-
-    plt.gca().set_aspect('equal', adjustable='box')
-    plt.axis("off")
-
-    canvas = plt.get_current_fig_manager().canvas
-    canvas.draw()
-    img_ethnicity = Image.frombytes('RGB', canvas.get_width_height(), canvas.tostring_rgb())
-
-    # Plot religions
-    total_religions = 5
-    for (x, y), house in np.ndenumerate(city):
-        if x > w or y > h:
-            continue
-        if not house.empty:
-            # Add a unique color for every religion
-            this_religion = house.occupant.religion.value
-            rc, gc, bc = colorsys.hls_to_rgb(this_religion / total_religions, 0.4, 1)
-            rgb_255 = (int(rc * 255), int(gc * 255), int(bc * 255))
-            if not house.landmark:
-                # Give the agents the color of their religion on the religion map
-                plt.scatter(x, y, c='#%02x%02x%02x' % rgb_255, s=100)
-            else:
-                # Give landmarks the color of their religion on the religion map, and make them a triangle
-                plt.scatter(x, y, c='#%02x%02x%02x' % rgb_255, s=100, marker="^")
-        else:
-            plt.scatter(x, y, c="black", s=100)
-    plt.gca().set_aspect('equal', adjustable='box')
-    plt.axis("off")
-
-    canvas = plt.get_current_fig_manager().canvas
-    canvas.draw()
-    img_religion = Image.frombytes('RGB', canvas.get_width_height(), canvas.tostring_rgb())
-
-    return img_religion, img_ethnicity, img_income
+    return render_frames(city, zoom)
 
 
 if __name__ == "__main__":
-    city = generate_city()
+    parser = argparse.ArgumentParser(description="Simulate the city and save plots and gifs of it")
+    parser.add_argument("--resume", help="checkpoint file to continue a run from")
+    args = parser.parse_args()
 
-    cluster_religion(city)
-    cluster_ethnicity(city)
     outpath = "out_" + str(w) + "x" + str(h) + "_r" + str(radius) + "_weights" + str(weight_list[0]) + str(weight_list[1]) + str(weight_list[2])
     os.makedirs(outpath, exist_ok=True)
 
-    # Bitmap for the gifs
-    data = np.zeros((h + 1, w + 1, 3), dtype=np.uint8)
-
-    # Plot house prices
-    # House prices are currently not used in our final version, however they are generated and
-    # could be used for future projects.
-    for (x, y), house in np.ndenumerate(city):
-        if x > w or y > h:
-            continue
-        if not (house.empty or house.landmark):
-            color = house.price / max_price * 255
-            data[x][y] = [255, color, color]
-        elif house.landmark:
-            data[x][y] = [255, 255, 0]
-        else:
-            data[x][y] = [0, 0, 0]
-
-    img = Image.fromarray(data, 'RGB')
-
-    # Upscale image so it's easier to see
-    img = img.resize((int(w * zoom), int(h * zoom)), Image.NEAREST)
-    img.save(outpath + "/house_prices.png")
-
-    avg_satisfaction_over_time = []
-
-    frames_religion = []
-    frames_ethnicity = []
-    frames_income = []
-    cluster_eth =[]
-    cluster_rel = []
-    inc_satisfaction = []
+    if args.resume:
+        # Continue exactly where the checkpoint was written, including the state of the random generator
+        checkpoint = load_checkpoint(args.resume)
+        rng = checkpoint.rng
+        city = checkpoint.city.to_object_grid(compact_objects)
+        vacancies = checkpoint.vacancies
+        satisfactions = SatisfactionCache(city, income_sum=checkpoint.income_sum,
+                                          feature_sums=checkpoint.feature_sums)
+        start = checkpoint.iteration
+        histories = checkpoint.histories
+        frame_offsets = checkpoint.frame_offsets
+    else:
+        rng = np.random.default_rng(seed)
+        city = generate_city(method=generation_method, rng=rng, compact=compact_objects)
+
+        cluster_religion(city)
+        cluster_ethnicity(city)
+
+        # Bitmap for the gifs
+        data = np.zeros((h + 1, w + 1, 3), dtype=np.uint8)
+
+        # Plot house prices
+        # House prices are currently not used in our final version, however they are generated and
+        # could be used for future projects.
+        for (x, y), house in np.ndenumerate(city):
+            if x > w or y > h:
+                continue
+            if not (house.empty or house.landmark):
+                color = house.price / max_price * 255
+                data[x][y] = [255, color, color]
+            elif house.landmark:
+                data[x][y] = [255, 255, 0]
+            else:
+                data[x][y] = [0, 0, 0]
+
+        img = Image.fromarray(data, 'RGB')
+
+        # Upscale image so it's easier to see
+        img = img.resize((int(w * zoom), int(h * zoom)), Image.NEAREST)
+        img.save(outpath + "/house_prices.png")
+
+        vacancies = VacancyIndex.from_city(city)
+        satisfactions = SatisfactionCache(city)
+        start = 0
+        histories = {}
+        frame_offsets = {}
+
+    religion_clusters = ClusterTracker.from_city(city, "religion")
+    ethnicity_clusters = ClusterTracker.from_city(city, "ethnicity")
+    observers = [religion_clusters, ethnicity_clusters]
+    if record_trajectory:
+        # Every move is written to disk, read it back with trajectory.Trajectory
+        recorder = TrajectoryRecorder(outpath + "/trajectory", city, resume_step=start if args.resume else None)
+        observers.append(recorder)
+    instruments = Instrumentation(outpath + "/instrumentation.jsonl", enabled=instrument or bool(profile_steps),
+                                  track_memory=instrument_memory, profile_steps=profile_steps,
+                                  profile_path=outpath + "/profile.prof")
+    if instruments.enabled:
+        observers.append(instruments)
+    # Each metric is sampled at its own interval, the income comparison optionally in a worker process.
+    # The scheduler keeps a copy of the city as arrays, which the frames are drawn from and the metrics computed on
+    metrics = MetricsScheduler(city, [
+        Metric("inc_satisfaction", income_comparison, income_every, metrics_in_background),
+        Metric("cluster_eth", lambda city: ethnicity_clusters.count, cluster_every),
+        Metric("cluster_rel", lambda city: religion_clusters.count, cluster_every)], histories=histories)
+    observers.append(metrics)
+    if update_mode != SEQUENTIAL:
+        # Batch steps work on arrays, the object grid, vacancies and satisfaction cache follow their moves
+        arrays = CityArrays.from_object_grid(city)
+        batch_observers = [GridMover(city), vacancies, satisfactions] + observers
+    prospects = None
+    if check_future_home and update_mode == SEQUENTIAL:
+        # Agents that check their future home pick among the houses they would be satisfied in
+        prospects = ProspectIndex(satisfactions, vacancies, members=checkpoint.prospects if args.resume else None)
+
+    # Frames are written to the gifs as they are drawn instead of being kept in memory
+    frames_religion = GifStreamWriter(outpath + "/religion.gif", duration=200, loop=1,
+                                      resume_at=frame_offsets.get("religion", 0))
+    frames_ethnicity = GifStreamWriter(outpath + "/ethnicities.gif", duration=200, loop=1,
+                                       resume_at=frame_offsets.get("ethnicity", 0))
+    frames_income = GifStreamWriter(outpath + "/income.gif", duration=200, loop=1,
+                                    resume_at=frame_offsets.get("income", 0))
+    avg_satisfaction_over_time = histories.get("avg_satisfaction", [])
+    if checkpoint_every:
+        os.makedirs(outpath + "/checkpoints", exist_ok=True)
     # Go up to max_iterations, reaching max iterations is a terminating condition
-    for i in range(0, max_iterations):
-        frame_religion, frame_ethnicity, frame_income = get_frame(city)
-        frames_religion.append(frame_religion)
-        frames_ethnicity.append(frame_ethnicity)
-        frames_income.append(frame_income)
-        inc_satisfaction.append(income_comparison(city))
-        e_c, e_s = cluster_ethnicity(city)
-        r_c, r_s = cluster_religion(city)
-        cluster_eth.append(e_c)
-        cluster_rel.append(r_c)
-        avg_satisfaction = time_step(i)
+    for i in range(start, max_iterations):
+        instruments.start_step(i)
+        if checkpoint_every and i % checkpoint_every == 0:
+            with instruments.phase("checkpoint"):
+                save_checkpoint(outpath + f"/checkpoints/step_{i:06d}.npz", city, i, vacancies, rng, satisfactions,
+                                histories={"avg_satisfaction": avg_satisfaction_over_time, **metrics.histories()},
+                                frame_offsets={"religion": frames_religion.tell(),
+                                               "ethnicity": frames_ethnicity.tell(),
+                                               "income": frames_income.tell()},
+                                prospects=prospects)
+        if i % frame_every == 0:
+            with instruments.phase("render"):
+                frame_religion, frame_ethnicity, frame_income = get_frame(metrics.arrays)
+                frames_religion.write(frame_religion)
+                frames_ethnicity.write(frame_ethnicity)
+                frames_income.write(frame_income)
+        with instruments.phase("metrics"):
+            metrics.sample(i)
+        with instruments.phase("time_step"):
+            if update_mode == SEQUENTIAL:
+                avg_satisfaction = time_step(i, city, vacancies, observers=observers, cache=satisfactions, rng=rng,
+                                             prospects=prospects)
+            else:
+                if i % 2 == 0:
+                    print(i)
+                batch_time_step(arrays, rng, mode=update_mode, check_future_home=check_future_home,
+                                observers=batch_observers)
+                avg_satisfaction = satisfactions.satisfied_ratio()
+        if record_trajectory:
+            with instruments.phase("record"):
+                recorder.end_step()
+        instruments.end_step(unsatisfied=len(satisfactions.unsatisfied), satisfaction=avg_satisfaction)
         # If the average satisfaction reaches the threshold, trigger the second possible terminating condition
         if avg_satisfaction > satisfaction_threshold:
             break
 
         avg_satisfaction_over_time.append(avg_satisfaction)
 
+    instruments.close()
+    metrics.close()
+    inc_satisfaction = metrics.values("inc_satisfaction")
+    cluster_eth = metrics.values("cluster_eth")
+    cluster_rel = metrics.values("cluster_rel")
+    frames_religion.close()
+    frames_ethnicity.close()
+    frames_income.close()
+
     # Satisfaction over time plot
     plt.clf()
     plt.plot(avg_satisfaction_over_time)
@@ -306,14 +427,9 @@ if __name__ == "__main__":
     plt.savefig(outpath + "/avg_satisfaction.png")
     print(f"average satisfaction: {avg_satisfaction}")
 
-    frames_ethnicity[0].save(outpath + "/ethnicities.gif", append_images=frames_ethnicity[1:], save_all=True, duration=200,
-                             loop=1)
-    frames_income[0].save(outpath + "/income.gif", append_images=frames_income[1:], save_all=True, duration=200, loop=1)
-    frames_religion[0].save(outpath + "/religion.gif", append_images=frames_religion[1:], save_all=True, duration=200, loop=1)
-    
     # Ethnicity cluster plot
     plt.clf()
-    plt.plot(cluster_eth)
+    plt.plot(metrics.steps("cluster_eth"), cluster_eth)
     plt.title("Cluster Count Over Time for Ethnicity")
     plt.xlabel("Number of Steps")
     plt.ylabel("Number of Clusters")
@@ -321,7 +437,7 @@ if __name__ == "__main__":
     
     # Religion cluster plot
     plt.clf()
-    plt.plot(cluster_rel)
+    plt.plot(metrics.steps("cluster_rel"), cluster_rel)
     plt.title("Cluster Count Over Time for Religion")
     plt.xlabel("Number of Steps")
     plt.ylabel("Number of Clusters")
@@ -331,7 +447,7 @@ if __name__ == "__main__":
 
     # Income satisfaction plot
     plt.clf()
-    plt.plot(inc_satisfaction)
+    plt.plot(metrics.steps("inc_satisfaction"), inc_satisfaction)
     plt.title("Neighbor Income Satisfaction over Time")
     plt.xlabel("Number of Steps")
     plt.ylabel("Average Satisfaction regarding Neighbor Incomes")
@@ -341,8 +457,8 @@ if __name__ == "__main__":
 
     # Combined cluster
     plt.clf()
-    plt.plot(cluster_rel, label='Religion')
-    plt.plot(cluster_eth, label='Ethnicity')
+    plt.plot(metrics.steps("cluster_rel"), cluster_rel, label='Religion')
+    plt.plot(metrics.steps("cluster_eth"), cluster_eth, label='Ethnicity')
     plt.title("Cluster Count Over Time")
     plt.xlabel("Number of Steps")
     plt.ylabel("Number of Clusters")
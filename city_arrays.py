@@ -0,0 +1,217 @@
+import numpy as np
+
+from agent import Agent, BinaryFeature, CategoricalFeature, RealNumberFeature, religion_preference_matrix
+from compact import default_model, object_model
+from features import extra_features
+from params import weight_list
+
+
+class CityArrays:
+    """A city grid stored as one typed array per attribute instead of a grid of Home/Agent objects.
+
+    Every array has the shape of the object grid (including its padding). Religion codes are shared by
+    agents and landmarks, the other agent attributes are only meaningful where `occupied` is True.
+    Features registered in features.py get a layer of their own, named after them."""
+
+    layers = ("religion", "ethnicity", "income", "price", "empty", "landmark")
+    # The layers that move with an agent
+    agent_layers = ("religion", "ethnicity", "income")
+
+    def __init__(self, shape, preference_matrix=religion_preference_matrix, weights=None,
+                 income_threshold=30000):
+        self.religion = np.zeros(shape, dtype=np.int8)
+        self.ethnicity = np.zeros(shape, dtype=np.bool_)
+        self.income = np.zeros(shape, dtype=np.float32)
+        self.price = np.zeros(shape, dtype=np.float32)
+        self.empty = np.ones(shape, dtype=np.bool_)
+        self.landmark = np.zeros(shape, dtype=np.bool_)
+        extra = tuple(feature.name for feature in extra_features())
+        for feature in extra_features():
+            setattr(self, feature.name, np.zeros(shape, dtype=feature.dtype))
+        self.layers = CityArrays.layers + extra
+        self.agent_layers = CityArrays.agent_layers + extra
+        self.preference_matrix = preference_matrix
+        if weights is None:
+            weights = weight_list
+        self.weights = weights
+        self.income_threshold = income_threshold
+
+    @property
+    def shape(self):
+        return self.empty.shape
+
+    @property
+    def occupied(self):
+        """Mask of the homes that hold an agent (not empty and not a landmark)"""
+        return ~(self.empty | self.landmark)
+
+    def packed_occupancy(self):
+        """The occupied mask packed 8 cells per byte, e.g. for storing on disk"""
+        return np.packbits(self.occupied)
+
+    def set_packed_occupancy(self, bits):
+        """Mark the cells in a packed occupancy mask as occupied and all other non-landmark cells as empty
+        :param bits: output of packed_occupancy for a city of the same shape"""
+        occupied = np.unpackbits(bits, count=self.empty.size).reshape(self.shape).astype(np.bool_)
+        self.empty = ~(occupied | self.landmark)
+
+    def move(self, src, dst):
+        """Move the agent living at src into the empty home at dst
+        :param src: (x, y) of the agent's current home
+        :param dst: (x, y) of the empty home"""
+        for name in self.agent_layers:
+            getattr(self, name)[dst] = getattr(self, name)[src]
+        self.empty[dst] = False
+        self.empty[src] = True
+
+    def copy(self):
+        other = CityArrays(self.shape, self.preference_matrix, self.weights, self.income_threshold)
+        for name in self.layers:
+            getattr(other, name)[...] = getattr(self, name)
+        return other
+
+    def row_band(self, start, stop):
+        """A CityArrays of rows start:stop whose layers are views of these, so changes show up in both"""
+        band = CityArrays((0, 0), self.preference_matrix, self.weights, self.income_threshold)
+        for name in self.layers:
+            setattr(band, name, getattr(self, name)[start:stop])
+        return band
+
+    @classmethod
+    def from_object_grid(cls, grid, **kwargs):
+        """Convert a grid of Home objects (as made by city.generate_city) to arrays"""
+        arrays = cls(grid.shape, **kwargs)
+        for (x, y), house in np.ndenumerate(grid):
+            arrays.price[x, y] = house.price
+            arrays.empty[x, y] = house.empty
+            arrays.landmark[x, y] = house.landmark
+            if house.empty:
+                continue
+            arrays.religion[x, y] = house.occupant.religion.value
+            if not house.landmark:
+                arrays.ethnicity[x, y] = house.occupant.ethnicity.value
+                arrays.income[x, y] = house.occupant.income.value
+                for feature in extra_features():
+                    if hasattr(house.occupant, feature.name):
+                        getattr(arrays, feature.name)[x, y] = getattr(house.occupant, feature.name).value
+        return arrays
+
+    def to_object_grid(self, compact=False):
+        """Build a grid of Home objects holding the same city, for the object-model code path
+        :param compact: build it from the slotted classes with shared features of compact.py"""
+        model = object_model(compact)
+        grid = np.zeros(self.shape, dtype=object)
+        for (x, y), empty in np.ndenumerate(self.empty):
+            grid[x][y] = model.home(price=float(self.price[x, y]), empty=bool(empty),
+                                    landmark=bool(self.landmark[x, y]), occupant=self._make_occupant(x, y, model))
+        return grid
+
+    def _make_occupant(self, x, y, model=default_model):
+        if self.empty[x, y]:
+            return None
+        religion = model.categorical(value=int(self.religion[x, y]), preference_matrix=self.preference_matrix)
+        if self.landmark[x, y]:
+            return model.landmark(religion=religion, landmark=1)
+        return model.agent(religion=religion,
+                           ethnicity=model.binary(value=bool(self.ethnicity[x, y])),
+                           income=model.real(value=float(self.income[x, y]), threshold=self.income_threshold),
+                           landmark=0,
+                           weights=self.weights,
+                           **{feature.name: model.wrap(feature, getattr(self, feature.name)[x, y])
+                              for feature in extra_features()})
+
+    def as_grid(self):
+        """An object array of HomeView adapters over these arrays.
+
+        Code written for the object grid (Agent.satisfied, get_frame, cluster_counts, time_step) can run
+        on the result unchanged, reads and writes go straight to the arrays."""
+        grid = np.empty(self.shape, dtype=object)
+        for (x, y), _ in np.ndenumerate(grid):
+            grid[x, y] = HomeView(self, x, y)
+        return grid
+
+
+class HomeView:
+    """A Home-like adapter for one cell of a CityArrays"""
+
+    def __init__(self, arrays, x, y):
+        self.arrays = arrays
+        self.x = x
+        self.y = y
+
+    @property
+    def price(self):
+        return float(self.arrays.price[self.x, self.y])
+
+    @property
+    def empty(self):
+        return bool(self.arrays.empty[self.x, self.y])
+
+    @empty.setter
+    def empty(self, value):
+        self.arrays.empty[self.x, self.y] = value
+
+    @property
+    def landmark(self):
+        return bool(self.arrays.landmark[self.x, self.y])
+
+    @property
+    def occupant(self):
+        if self.empty:
+            return None
+        if self.landmark:
+            return self.arrays._make_occupant(self.x, self.y)
+        return AgentView(self.arrays, self.x, self.y)
+
+    @occupant.setter
+    def occupant(self, agent):
+        # Moving out is recorded by setting empty, the stale values left behind are never read
+        if agent is None:
+            return
+        self.arrays.religion[self.x, self.y] = agent.religion.value
+        self.arrays.ethnicity[self.x, self.y] = agent.ethnicity.value
+        self.arrays.income[self.x, self.y] = agent.income.value
+        for feature in extra_features():
+            getattr(self.arrays, feature.name)[self.x, self.y] = getattr(agent, feature.name).value
+
+    def __str__(self):
+        return str(self.price)
+
+
+class AgentView(Agent):
+    """An Agent whose features are read from a cell of a CityArrays"""
+
+    def __init__(self, arrays, x, y):
+        self.arrays = arrays
+        self.x = x
+        self.y = y
+        self.weights = arrays.weights
+        self.landmark = 0
+
+    @property
+    def religion(self):
+        return CategoricalFeature(value=int(self.arrays.religion[self.x, self.y]),
+                                  preference_matrix=self.arrays.preference_matrix)
+
+    @property
+    def ethnicity(self):
+        return BinaryFeature(value=bool(self.arrays.ethnicity[self.x, self.y]))
+
+    @property
+    def income(self):
+        return RealNumberFeature(value=float(self.arrays.income[self.x, self.y]),
+                                 threshold=self.arrays.income_threshold)
+
+    def __getattr__(self, name):
+        # Only called for names that are not found otherwise, i.e. the registered features
+        for feature in extra_features():
+            if feature.name == name:
+                return feature.wrap(getattr(self.arrays, name)[self.x, self.y])
+        raise AttributeError(name)
+
+    def __eq__(self, other):
+        return isinstance(other, AgentView) and other.arrays is self.arrays and \
+               (other.x, other.y) == (self.x, self.y)
+
+    def __hash__(self):
+        return hash((id(self.arrays), self.x, self.y))
@@ -1,4 +1,8 @@
+from collections import deque
+
 import numpy as np
+from city_arrays import CityArrays
+from neighborhood import VON_NEUMANN, income_ratio_sum, neighbor_sum
 from params import *
 
 
@@ -18,155 +22,279 @@ def agent_count(city):
             empty += 1
 
 
-def cluster_religion(city):
-    """Counts hoshen_kopelman clusters for religion"""
-    agent_counted = []
-    clusters = []
-    for (x,y), house in np.ndenumerate(city):
-        if x > w or y > h:
-            continue
-        if not (house.empty or house.landmark):
-            agent = house.occupant
-            if x==0 and y==0:
-                clusters.append([agent.religion.value,[[x,y]]])  
-                agent_counted.append([x,y])
-            elif x==0:
-                for cluster in clusters:
-                    if [x,y-1] in cluster[1] and agent.religion.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        break
-                if [x,y] not in agent_counted:
-                    clusters.append([agent.religion.value,[[x,y]]])
-                    agent_counted.append([x,y])
-            elif y==0:
-                for cluster in clusters:
-                    if [x-1,y] in cluster[1] and agent.religion.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        break
-                if [x,y] not in agent_counted:
-                    clusters.append([agent.religion.value,[[x,y]]])
-                    agent_counted.append([x,y])
-            else:
-                for cluster in clusters:
-                    if [x,y-1] in cluster[1] and agent.religion.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        for cluster_check in clusters:
-                            if [x-1,y] in cluster_check[1] and agent.religion.value == cluster_check[0] and cluster_check != cluster:
-                                for i in cluster_check[1]:
-                                    cluster[1].append(i)
-                                clusters.remove(cluster_check)
-                                break
-                        break
-                    elif [x-1,y] in cluster[1] and agent.religion.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        for cluster_check in clusters:
-                            if [x,y-1] in cluster_check[1] and agent.religion.value == cluster_check[0] and cluster_check != cluster:
-                                for i in cluster_check[1]:
-                                    cluster[1].append(i)
-                                clusters.remove(cluster_check)
-                                break
-                        break
-                if [x,y] not in agent_counted:
-                    clusters.append([agent.religion.value,[[x,y]]])
-                    agent_counted.append([x,y])
-            continue
+def label_clusters(values, mask):
+    """Hoshen-Kopelman labelling of the clusters of a categorical layer: the groups of masked cells that
+    are connected horizontally or vertically through cells with the same value.
+    Runs union-find on the whole grid at once, by hooking the root of every cell to the smaller root of a
+    matching neighbor and compressing the paths, until no two matching neighbors have different roots.
+    Leading axes (e.g. several cities) are labelled separately, only the last two are connected.
+    :param values: category of every cell
+    :param mask: which cells take part, e.g. the houses that hold an agent
+    :return (labels, sizes): labels holds the cluster number of every cell (-1 where not masked),
+    sizes holds the number of cells in each cluster"""
+    index = np.arange(values.size).reshape(values.shape)
+    first = []
+    second = []
+    for axis in (-2, -1):
+        a = np.moveaxis(index, axis, 0)[:-1].ravel()
+        b = np.moveaxis(index, axis, 0)[1:].ravel()
+        first.append(a)
+        second.append(b)
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    flat_values = values.ravel()
+    flat_mask = mask.ravel()
+    matching = flat_mask[first] & flat_mask[second] & (flat_values[first] == flat_values[second])
+    parent = union_roots(values.size, first[matching], second[matching])
+
+    labels = np.full(values.size, -1)
+    roots, labels[flat_mask], sizes = np.unique(parent[flat_mask], return_inverse=True, return_counts=True)
+    return labels.reshape(values.shape), sizes
+
+
+def union_roots(size, first, second):
+    """Vectorized union-find: join the elements first[k] and second[k] for every k, by hooking the root of
+    each to the smaller root of the other and compressing the paths, until every pair has the same root
+    :param size: number of elements
+    :return array that maps every element to the smallest element of its group"""
+    parent = np.arange(size)
+    while first.size:
+        root_first = parent[first]
+        root_second = parent[second]
+        split = root_first != root_second
+        if not split.any():
+            break
+        first, second = first[split], second[split]
+        root_first, root_second = root_first[split], root_second[split]
+        np.minimum.at(parent, np.maximum(root_first, root_second), np.minimum(root_first, root_second))
+        # Path compression, point every cell straight at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    return parent
+
+
+def cluster_stats(values, mask):
+    """Count the clusters of a categorical layer
+    :return tuple of number of clusters, mean cluster size and the sizes of all clusters"""
+    labels, sizes = label_clusters(values, mask)
+    mean_cluster_size = sizes.mean() if len(sizes) else 0
+    return len(sizes), mean_cluster_size, sizes
 
-    total_count = 0
-    for i in clusters:
-        total_count += len(i[1])
-    mean_cluster_size = total_count/len(clusters)
-    return len(clusters), mean_cluster_size
+
+def feature_layer(city, feature):
+    """The values of a feature ("religion" or "ethnicity") and the mask of agents, over the part of the
+    grid that the cluster counts look at (all but the last row and column of the padding)
+    :param city: object grid or CityArrays, whose layers may have leading axes (e.g. an ensemble)"""
+    if not isinstance(city, CityArrays):
+        city = CityArrays.from_object_grid(city)
+    rows, cols = city.shape[-2] - 1, city.shape[-1] - 1
+    return getattr(city, feature)[..., :rows, :cols], city.occupied[..., :rows, :cols]
+
+
+def cluster_religion(city):
+    """Counts hoshen_kopelman clusters for religion
+    :return tuple of number of clusters and mean cluster size"""
+    count, mean_cluster_size, sizes = cluster_stats(*feature_layer(city, "religion"))
+    return count, mean_cluster_size
 
 
 def cluster_ethnicity(city):
-    """Counts hoshen_kopelman clusters for ethnicity"""
-    agent_counted = []
-    clusters = []
-    for (x,y), house in np.ndenumerate(city):
-        if x > w or y > h:
-            continue
-        if not (house.empty or house.landmark):
-            agent = house.occupant
-            if x==0 and y==0:
-                clusters.append([agent.ethnicity.value,[[x,y]]])  
-                agent_counted.append([x,y])
-            elif x==0:
-                for cluster in clusters:
-                    if [x,y-1] in cluster[1] and agent.ethnicity.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        break
-                if [x,y] not in agent_counted:
-                    clusters.append([agent.ethnicity.value,[[x,y]]])
-                    agent_counted.append([x,y])
-            elif y==0:
-                for cluster in clusters:
-                    if [x-1,y] in cluster[1] and agent.ethnicity.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        break
-                if [x,y] not in agent_counted:
-                    clusters.append([agent.ethnicity.value,[[x,y]]])
-                    agent_counted.append([x,y])
-            else:
-                for cluster in clusters:
-                    if [x,y-1] in cluster[1] and agent.ethnicity.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        for cluster_check in clusters:
-                            if [x-1,y] in cluster_check[1] and agent.ethnicity.value == cluster_check[0] and cluster_check != cluster:
-                                for i in cluster_check[1]:
-                                    cluster[1].append(i)
-                                clusters.remove(cluster_check)
-                                break
-                        break
-                    elif [x-1,y] in cluster[1] and agent.ethnicity.value == cluster[0]:
-                        cluster[1].append([x,y])
-                        agent_counted.append([x,y])
-                        for cluster_check in clusters:
-                            if [x,y-1] in cluster_check[1] and agent.ethnicity.value == cluster_check[0] and cluster_check != cluster:
-                                for i in cluster_check[1]:
-                                    cluster[1].append(i)
-                                clusters.remove(cluster_check)
-                                break
-                        break
-                if [x,y] not in agent_counted:
-                    clusters.append([agent.ethnicity.value,[[x,y]]])
-                    agent_counted.append([x,y])
-            continue
+    """Counts hoshen_kopelman clusters for ethnicity
+    :return tuple of number of clusters and mean cluster size"""
+    count, mean_cluster_size, sizes = cluster_stats(*feature_layer(city, "ethnicity"))
+    return count, mean_cluster_size
 
-    total_count = 0
-    for i in clusters:
-        total_count += len(i[1])
-    mean_cluster_size = total_count/len(clusters)
-    return len(clusters), mean_cluster_size
 
+class ClusterTracker:
+    """Keeps the clusters of one categorical layer up to date while agents move, instead of labelling
+    the whole grid again after every step. It gives the same numbers as cluster_stats on the same area.
 
-def income_comparison(city):
-    """Income comparison"""
-    income_happiness = []
-    for (x,y), house in np.ndenumerate(city):
-        if x > w or y > h:
-            continue
-        if not (house.empty or house.landmark):
-            agent = house.occupant
-            house_neighbors = []
-            for i in range(x - 1, x + 1 + 1):
-                for j in range(y - 1, y + 1 + 1):
-                    if i==x or j==y:
-                        if 0 <= i < len(city)-1 and 0 <= j < len(city[0])-1:
-                            if not city[i][j].empty and city[i][j].occupant != agent and not city[i][j].landmark:
-                                house_neighbors.append(city[i][j].occupant)
-            income_gap = 0
-            for neighbor in house_neighbors:
-                income_gap += min(agent.income.value, neighbor.income.value)/max(agent.income.value, neighbor.income.value)
-            if income_gap == 0:
-                income_happiness.append(0)
-            else:
-                income_happiness.append(income_gap/len(house_neighbors))
-        continue
-    return sum(income_happiness)/len(income_happiness)
+    An arriving agent merges the clusters around it, the smaller ones are relabelled into the biggest.
+    When an agent leaves, its cluster may fall apart: a search is started from each of its former
+    neighbors in the cluster, one cell at a time in turn, and the pieces that are closed off before the
+    others meet get a new label. The cost of a move depends on the size of the smaller clusters only."""
+
+    def __init__(self, values, mask):
+        """:param values: category of every cell of the full grid
+        :param mask: which cells hold an agent"""
+        self.values = np.array(values)
+        self.mask = np.array(mask, dtype=bool)
+        # Like the cluster counts, the last row and column of the padding are left out
+        self.rows, self.cols = self.values.shape[0] - 1, self.values.shape[1] - 1
+        self.labels = np.full(self.values.shape, -1)
+        labels, sizes = label_clusters(self.values[:self.rows, :self.cols], self.mask[:self.rows, :self.cols])
+        self.labels[:self.rows, :self.cols] = labels
+        self.sizes = dict(enumerate(sizes.tolist()))
+        self.next_label = len(sizes)
+
+    @classmethod
+    def from_city(cls, city, feature):
+        """Track the clusters of a feature ("religion" or "ethnicity") of an object grid or CityArrays"""
+        if not isinstance(city, CityArrays):
+            city = CityArrays.from_object_grid(city)
+        return cls(getattr(city, feature), city.occupied)
+
+    @property
+    def count(self):
+        return len(self.sizes)
+
+    @property
+    def mean_size(self):
+        return sum(self.sizes.values()) / len(self.sizes) if self.sizes else 0
+
+    def stats(self):
+        """Same as cluster_stats: number of clusters, mean cluster size and the sizes of all clusters"""
+        return self.count, self.mean_size, np.array(list(self.sizes.values()))
+
+    def move(self, src, dst):
+        """Record that the agent at src moved into the empty home at dst"""
+        value = self.values[src]
+        self.mask[src] = False
+        if self._inside(src):
+            self._leave(src)
+        self.values[dst] = value
+        self.mask[dst] = True
+        if self._inside(dst):
+            self._arrive(dst)
+
+    def _inside(self, cell):
+        return cell[0] < self.rows and cell[1] < self.cols
+
+    def _matching_neighbors(self, cell, label=None):
+        """Neighbors of a cell that are in the same cluster, or would be if an agent lived in the cell"""
+        x, y = cell
+        for i, j in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if 0 <= i < self.rows and 0 <= j < self.cols and self.labels[i, j] != -1:
+                if label is None and self.values[i, j] == self.values[x, y] or self.labels[i, j] == label:
+                    yield i, j
+
+    def _arrive(self, cell):
+        neighbor_labels = {self.labels[n] for n in self._matching_neighbors(cell)}
+        if not neighbor_labels:
+            label = self.next_label
+            self.next_label += 1
+            self.sizes[label] = 0
+        else:
+            label = max(neighbor_labels, key=self.sizes.get)
+            for n in self._matching_neighbors(cell):
+                if self.labels[n] != label:
+                    self.sizes[label] += self.sizes.pop(self.labels[n])
+                    self._relabel(self._flood(n), label)
+        self.labels[cell] = label
+        self.sizes[label] += 1
+
+    def _leave(self, cell):
+        label = self.labels[cell]
+        self.labels[cell] = -1
+        self.sizes[label] -= 1
+        if self.sizes[label] == 0:
+            del self.sizes[label]
+            return
+        starts = list(self._matching_neighbors(cell, label))
+        if len(starts) < 2:
+            return
+        for piece in self._split(starts, label):
+            new_label = self.next_label
+            self.next_label += 1
+            self.sizes[new_label] = len(piece)
+            self.sizes[label] -= len(piece)
+            self._relabel(piece, new_label)
+
+    def _flood(self, start):
+        """All cells of the cluster that start is in"""
+        label = self.labels[start]
+        seen = {start}
+        queue = deque([start])
+        while queue:
+            for n in self._matching_neighbors(queue.popleft(), label):
+                if n not in seen:
+                    seen.add(n)
+                    queue.append(n)
+        return seen
+
+    def _split(self, starts, label):
+        """Search a cluster from several cells at once, one cell per search in turn. Searches that meet are
+        in the same piece and are joined. Stops when at most one search is still going.
+        :return the cells of all pieces that were searched completely, except one if none is left"""
+        owner = {}
+        merged_into = list(range(len(starts)))
+        queues = []
+        members = []
+        for k, start in enumerate(starts):
+            owner[start] = k
+            queues.append(deque([start]))
+            members.append([start])
+
+        def root(k):
+            while merged_into[k] != k:
+                k = merged_into[k]
+            return k
+
+        active = list(range(len(queues)))
+        finished = []
+        while len(active) > 1:
+            for k in list(active):
+                if k not in active:
+                    continue
+                if not queues[k]:
+                    active.remove(k)
+                    finished.append(k)
+                    continue
+                for n in self._matching_neighbors(queues[k].popleft(), label):
+                    other = owner.get(n)
+                    if other is None:
+                        owner[n] = k
+                        queues[k].append(n)
+                        members[k].append(n)
+                    elif root(other) != k:
+                        other = root(other)
+                        merged_into[other] = k
+                        queues[k].extend(queues[other])
+                        members[k].extend(members[other])
+                        active.remove(other)
+        if not active:
+            # Every piece was searched to the end, the biggest keeps the old label
+            finished.remove(max(finished, key=lambda k: len(members[k])))
+        return [members[k] for k in finished]
+
+    def _relabel(self, cells, label):
+        for cell in cells:
+            self.labels[cell] = label
+
+
+def income_comparison_map(city, radius=1, kind=VON_NEUMANN, weighted=False):
+    """For every agent, the mean over its agent neighbors of min(income, neighbor)/max(income, neighbor),
+    0 for agents without neighbors, over the same area as the cluster counts. Computed for the whole grid
+    at once from shifted copies of the income layer, empty homes and landmarks are masked out.
+    :param city: object grid or CityArrays, whose layers may have leading axes (e.g. an ensemble)
+    :param radius: maximum distance of the neighbors
+    :param kind: shape of the neighborhood, see neighborhood.py
+    :param weighted: count a neighbor at distance d radius - d + 1 times, like city.neighbors_weighted
+    :return array over the area, NaN where there is no agent"""
+    if not isinstance(city, CityArrays):
+        city = CityArrays.from_object_grid(city)
+    rows, cols = city.shape[-2] - 1, city.shape[-1] - 1
+    agents = city.occupied[..., :rows, :cols]
+    ratios = income_ratio_sum(city.income[..., :rows, :cols], agents, radius, weighted, kind)
+    count = neighbor_sum(agents.astype(np.int64), radius, weighted, kind)
+    happiness = np.divide(ratios, count, out=np.zeros(ratios.shape), where=count > 0)
+    return np.where(agents, happiness, np.nan)
+
+
+def income_comparison_stats(city, radius=1, kind=VON_NEUMANN, weighted=False):
+    """Income comparison with its distribution, see income_comparison_map for the arguments
+    :return tuple of the mean over agents (one per city if the layers have leading axes), the per-cell map
+    and the values of all agents"""
+    happiness = income_comparison_map(city, radius, kind, weighted)
+    agents = ~np.isnan(happiness)
+    mean = np.where(agents, happiness, 0).sum(axis=(-2, -1)) / agents.sum(axis=(-2, -1))
+    return mean, happiness, happiness[agents]
+
+
+def income_comparison(city, radius=1, kind=VON_NEUMANN, weighted=False):
+    """Income comparison: the average over agents of how close their income is to their neighbors'
+    :param city: object grid or CityArrays"""
+    return income_comparison_stats(city, radius, kind, weighted)[0]
@@ -0,0 +1,164 @@
+"""A memory-lean version of the object model, for big grids that are simulated with Home and Agent objects.
+
+The classes here hold the same attributes as Agent, Home and Landmark, but in __slots__ instead of a
+per-instance __dict__. Features with few values are shared: there is one CategoricalFeature per religion
+code and one BinaryFeature per value, handed out by a FeaturePool, instead of new ones for every agent.
+Feature objects are never changed after they are made, so sharing them is safe. Incomes are nearly all
+different, so every agent keeps its own income, in a CompactRealNumberFeature that only holds the value and
+is also faster to read than a shared one that lies anywhere in memory.
+
+Set compact_objects in params.py to build the grid of city.py with these classes."""
+from functools import lru_cache
+
+from agent import Agent, BinaryFeature, CategoricalFeature, RealNumberFeature
+from features import BinaryColumn, CategoricalColumn
+from home import Home
+from landmark import Landmark
+
+
+class FeaturePool:
+    """Hands out one shared feature object for every distinct value (a flyweight), takes the same arguments
+    as the feature classes"""
+
+    def __init__(self):
+        # One table of value to feature object for every kind of feature
+        self.tables = {}
+
+    def _intern(self, kind, value, make):
+        table = self.tables.setdefault(kind, {})
+        feature = table.get(value)
+        if feature is None:
+            feature = table[value] = make()
+        return feature
+
+    def categorical(self, value, preference_matrix, threshold=0.5):
+        # The matrix is kept alive by the features that hold it, so its id can't be reused
+        return self._intern((CategoricalFeature, id(preference_matrix), threshold), value,
+                            lambda: CategoricalFeature(value, preference_matrix, threshold))
+
+    def binary(self, value):
+        return self._intern(BinaryFeature, value, lambda: BinaryFeature(value))
+
+    def wrap(self, feature, value):
+        """The object of a feature registered in features.py, see FeatureColumn.wrap. Shared for categorical
+        and binary features, numbers get their own CompactRealNumberFeature"""
+        # Random values come as numpy scalars or 0-d arrays, which can't be dict keys
+        if hasattr(value, "item"):
+            value = value.item()
+        if not isinstance(feature, (CategoricalColumn, BinaryColumn)):
+            wrapped = feature.wrap(value)
+            return compact_real(wrapped.value, wrapped.threshold)
+        return self._intern(feature.name, value, lambda: feature.wrap(value))
+
+    def clear(self):
+        """Forget the shared objects, grids made earlier keep theirs"""
+        self.tables = {}
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+
+class CompactRealNumberFeature:
+    """A RealNumberFeature with only its value in a slot, the threshold and difference function are class
+    attributes. compact_real makes one with any threshold"""
+    __slots__ = ("value",)
+    threshold = 20000
+    difference_function = staticmethod(lambda x: x)
+
+    def __init__(self, value):
+        self.value = value
+
+    preference = RealNumberFeature.preference
+
+    def __reduce__(self):
+        # The subclasses of compact_real are made on the fly, pickle by value and threshold instead
+        return compact_real, (self.value, self.threshold)
+
+
+@lru_cache(maxsize=None)
+def _real_class(threshold):
+    """The subclass of CompactRealNumberFeature with a threshold"""
+    return type(CompactRealNumberFeature.__name__, (CompactRealNumberFeature,),
+                {"__slots__": (), "threshold": threshold})
+
+
+def compact_real(value, threshold=20000):
+    """A CompactRealNumberFeature, takes the same arguments as RealNumberFeature except difference_function"""
+    return _real_class(threshold)(value)
+
+
+# The pool every compact grid draws from
+pool = FeaturePool()
+
+
+class CompactAgent:
+    """An Agent with its attributes in slots, see Agent"""
+    # The features registered in features.py are kept in the __dict__, which is only made if there are any
+    __slots__ = ("religion", "ethnicity", "income", "weights", "landmark", "satisfaction", "__dict__")
+    satisfaction_threshold = 0.5
+
+    def __init__(self, religion, ethnicity, income, landmark, weights=None, **features):
+        """:param features: feature objects of the features registered in features.py, by name"""
+        self.religion = religion
+        self.ethnicity = ethnicity
+        self.income = income
+        if weights is None:
+            weights = [0, 1, 0]
+        self.weights = weights
+        self.landmark = landmark
+        for name, feature in features.items():
+            setattr(self, name, feature)
+
+    satisfied = Agent.satisfied
+    __str__ = Agent.__str__
+
+
+class CompactLandmark:
+    """A Landmark with its attributes in slots"""
+    __slots__ = ("religion", "landmark")
+
+    def __init__(self, religion, landmark):
+        self.religion = religion
+        self.landmark = landmark
+
+
+class CompactHome:
+    """A Home with its attributes in slots"""
+    __slots__ = ("price", "empty", "landmark", "occupant")
+
+    def __init__(self, price, empty, landmark, occupant):
+        self.price = price
+        self.empty = empty
+        self.landmark = landmark
+        self.occupant = occupant
+
+    def __str__(self):
+        return str(self.price)
+
+
+class ObjectModel:
+    """The classes a grid of objects is built from, the feature classes can also be functions that return
+    shared feature objects"""
+
+    def __init__(self, agent, home, landmark, categorical, binary, real, wrap):
+        self.agent = agent
+        self.home = home
+        self.landmark = landmark
+        self.categorical = categorical
+        self.binary = binary
+        self.real = real
+        self.wrap = wrap
+
+
+def _wrap(feature, value):
+    return feature.wrap(value)
+
+
+default_model = ObjectModel(Agent, Home, Landmark, CategoricalFeature, BinaryFeature, RealNumberFeature, _wrap)
+compact_model = ObjectModel(CompactAgent, CompactHome, CompactLandmark, pool.categorical, pool.binary,
+                            compact_real, pool.wrap)
+
+
+def object_model(compact):
+    """The ObjectModel of the compact classes if compact, else of the usual ones"""
+    return compact_model if compact else default_model
@@ -0,0 +1 @@
+# Its presence makes pytest put the repository root on sys.path, so the tests can import the modules
@@ -0,0 +1,107 @@
+"""Simulate many independent cities of the same size at once, for statistics over replicates.
+
+The cities are stacked along a leading axis of every layer of one CityArrays, so generation, the
+satisfaction kernel, relocation (batch_update.batch_time_step) and the metrics each run as one set of array
+operations over all replicates, instead of once per city with Python work for every house. A replicate
+stops moving once its satisfaction is above the threshold, like city.py does, its later metrics are NaN.
+
+Usage: python ensemble.py --replicates 500 --steps 100 --seed 0 --out ensemble.npz"""
+import argparse
+
+import numpy as np
+
+import params
+from batch_update import RANDOM_SEQUENTIAL, SYNCHRONOUS, batch_time_step
+from cluster_counts import feature_layer, income_comparison, label_clusters
+from generation import generate_city_arrays
+from landmark import LandmarkIndex
+from satisfaction import religion_threshold, satisfaction_grid
+
+metric_names = ("satisfaction", "religion_clusters", "ethnicity_clusters", "income_comparison")
+
+
+def replicate_cluster_counts(city, feature):
+    """Number of clusters of a feature ("religion" or "ethnicity") in every replicate, over the same area as
+    cluster_counts.cluster_religion
+    :return array with one count per replicate"""
+    values, mask = feature_layer(city, feature)
+    labels, sizes = label_clusters(values, mask)
+    # Clusters never span two replicates, a cluster belongs to the replicate of any of its cells
+    replicate = np.broadcast_to(np.arange(len(values))[:, None, None], values.shape)
+    owner = np.zeros(len(sizes), dtype=np.intp)
+    owner[labels[mask]] = replicate[mask]
+    return np.bincount(owner, minlength=len(values))
+
+
+class Ensemble:
+    """Replicates of a city stepped together as one CityArrays with a leading replicate axis"""
+
+    def __init__(self, replicates, rng=None, w=params.w, h=params.h, weights=params.weight_list,
+                 radius=params.radius, kind=params.neighborhood_shape, **generation_settings):
+        """:param replicates: number of cities
+        :param rng: numpy random Generator for generation and moves
+        :param generation_settings: other arguments of generation.generate_city_arrays, which default to
+        params.py"""
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.city = generate_city_arrays(w, h, weights, rng=self.rng, replicates=replicates, **generation_settings)
+        self.radius = radius
+        self.kind = kind
+        self.landmarks = LandmarkIndex.from_city(self.city, radius, kind, threshold=religion_threshold)
+        self.active = np.ones(replicates, dtype=bool)
+
+    def satisfied(self):
+        """Which cells hold a satisfied agent, agents of replicates that stopped count as satisfied"""
+        happy = satisfaction_grid(self.city, self.radius, kind=self.kind, landmarks=self.landmarks)[0] > 0.5
+        return (happy | ~self.active[:, None, None]).ravel()
+
+    def step(self, mode=SYNCHRONOUS, check_future_home=params.check_future_home):
+        """Move the unsatisfied agents of every active replicate
+        :return satisfaction ratio of every replicate at the start of the step"""
+        return batch_time_step(self.city, self.rng, self.radius, kind=self.kind, mode=mode,
+                               check_future_home=check_future_home, satisfied=self.satisfied,
+                               landmarks=self.landmarks)
+
+    def metrics(self):
+        """Cluster counts and income comparison of every replicate
+        :return dict of metric name to an array with one value per replicate"""
+        return {"religion_clusters": replicate_cluster_counts(self.city, "religion"),
+                "ethnicity_clusters": replicate_cluster_counts(self.city, "ethnicity"),
+                "income_comparison": income_comparison(self.city)}
+
+    def run(self, steps=params.max_iterations, threshold=params.satisfaction_threshold, mode=SYNCHRONOUS,
+            check_future_home=params.check_future_home):
+        """Step all replicates until each is satisfied above the threshold or the steps run out. Like the
+        main loop of city.py, the metrics of a step are taken before it
+        :return dict of metric name to an array of shape (replicate, step), NaN after a replicate stopped,
+        and "steps", the number of steps each replicate took"""
+        results = {name: np.full((len(self.active), steps), np.nan) for name in metric_names}
+        taken = np.zeros(len(self.active), dtype=int)
+        for i in range(steps):
+            if not self.active.any():
+                break
+            active = self.active.copy()
+            for name, values in self.metrics().items():
+                results[name][active, i] = values[active]
+            satisfaction = self.step(mode, check_future_home)
+            results["satisfaction"][active, i] = satisfaction[active]
+            taken[active] = i + 1
+            self.active &= ~(satisfaction > threshold)
+        results["steps"] = taken
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate many replicates of the city together")
+    parser.add_argument("--replicates", type=int, default=100)
+    parser.add_argument("--steps", type=int, default=params.max_iterations)
+    parser.add_argument("--mode", choices=[SYNCHRONOUS, RANDOM_SEQUENTIAL], default=SYNCHRONOUS)
+    parser.add_argument("--seed", type=int, default=params.seed)
+    parser.add_argument("--out", default="ensemble.npz", help="file for the (replicate, step) metric arrays")
+    args = parser.parse_args()
+
+    ensemble = Ensemble(args.replicates, np.random.default_rng(args.seed))
+    results = ensemble.run(args.steps, mode=args.mode)
+    np.savez_compressed(args.out, **results)
+    final = results["satisfaction"][np.arange(args.replicates), results["steps"] - 1]
+    print(f"satisfaction after {results['steps'].mean():.1f} steps on average: "
+          f"{final.mean():.3f} +- {final.std():.3f}")
@@ -0,0 +1,183 @@
+"""The features agents compare with their neighbors, each stored as a column (a layer of a CityArrays).
+
+Every feature type compares an agent's value with its neighbors' values for whole arrays at once, so the
+satisfaction code never needs per-agent Python for a feature. `registry` lists the features in the order of
+weight_list in params.py: religion, ethnicity and income, then any feature added with register. A feature
+that weight_list has no weight for counts with weight 0.
+
+To add a feature, register it at the bottom of this file and give it a weight in weight_list, e.g.
+
+    register(ThresholdColumn("age", threshold=10, low=18, high=90))
+    register(CategoricalColumn("ethnic_group", np.identity(len(Ethnicity)), categories=len(Ethnicity)))
+
+    weight_list = [1, 0, 0, 1, 1]
+
+Every CityArrays made afterwards has a layer for it, generation fills it with random values for the agents,
+and satisfaction.py, batch_update.py and the object model (Agent.satisfied) take it into account."""
+import numpy as np
+
+from agent import BinaryFeature, CategoricalFeature, RealNumberFeature
+from neighborhood import MOORE, category_match_sum, income_ratio_sum, neighbor_sum, offset_counts, shifted
+from params import max_income, min_income
+
+
+class FeatureColumn:
+    """A feature of the agents, stored as one layer of a CityArrays named after it"""
+    dtype = np.float32
+
+    def __init__(self, name):
+        self.name = name
+
+    def matches(self, own, other, preference_matrix=None):
+        """How much agents with the values own like neighbors with the values other, from 0 to 1
+        :param own: array of values
+        :param other: array of values of the same shape
+        :param preference_matrix: the city's preference matrix, for features that use it"""
+        raise NotImplementedError
+
+    def neighbor_matches(self, values, agents, radius, weighted=False, kind=MOORE, preference_matrix=None):
+        """For every cell, the sum of the matches of its value with the values of its agent neighbors
+        :param values: the layer of this feature
+        :param agents: mask of the cells that hold an agent"""
+        total = np.zeros(values.shape)
+        for di, dj, count in offset_counts(radius, weighted, kind):
+            present = shifted(agents, di, dj, fill=False)
+            total += count * np.where(present, self.matches(values, shifted(values, di, dj), preference_matrix), 0)
+        return total
+
+    def random(self, rng, shape):
+        """Random values for new agents"""
+        raise NotImplementedError
+
+    def wrap(self, value):
+        """The feature object of agent.py that holds one value, for the object model"""
+        return RealNumberFeature(value=float(value))
+
+
+class CategoricalColumn(FeatureColumn):
+    """An unordered category, a neighbor is liked if the preference for its category is above the threshold"""
+    dtype = np.int8
+
+    def __init__(self, name, preference_matrix=None, threshold=0.5, categories=None):
+        """:param preference_matrix: preference_matrix[own][other] is how much own likes other. None for the
+        preference matrix of the city (religion)
+        :param categories: number of categories to draw random values from, codes are 0 to categories - 1"""
+        super().__init__(name)
+        self.preference_matrix = preference_matrix
+        self.threshold = threshold
+        self.categories = categories
+
+    def accept(self, preference_matrix=None):
+        """Boolean matrix, accept[own][other] is True if own likes other"""
+        matrix = self.preference_matrix if self.preference_matrix is not None else preference_matrix
+        return np.asarray(matrix) > self.threshold
+
+    def matches(self, own, other, preference_matrix=None):
+        return self.accept(preference_matrix)[np.asarray(own, dtype=np.intp), np.asarray(other, dtype=np.intp)]
+
+    def neighbor_matches(self, values, agents, radius, weighted=False, kind=MOORE, preference_matrix=None):
+        values = values.astype(np.intp)
+        return category_match_sum(values, agents, values, self.accept(preference_matrix), radius, weighted, kind)
+
+    def random(self, rng, shape):
+        return rng.integers(self.categories, size=shape)
+
+    def wrap(self, value):
+        return CategoricalFeature(value=int(value), preference_matrix=self.preference_matrix,
+                                  threshold=self.threshold)
+
+
+class BinaryColumn(FeatureColumn):
+    """A yes/no feature, a neighbor is liked if it has the same value"""
+    dtype = np.bool_
+
+    def __init__(self, name, probability=0.5):
+        """:param probability: chance that a new agent has the value True"""
+        super().__init__(name)
+        self.probability = probability
+
+    def matches(self, own, other, preference_matrix=None):
+        return np.asarray(own) == np.asarray(other)
+
+    def neighbor_matches(self, values, agents, radius, weighted=False, kind=MOORE, preference_matrix=None):
+        same = neighbor_sum((agents & values).astype(np.int64), radius, weighted, kind)
+        count = neighbor_sum(agents.astype(np.int64), radius, weighted, kind)
+        return np.where(values, same, count - same)
+
+    def random(self, rng, shape):
+        return rng.random(shape) < self.probability
+
+    def wrap(self, value):
+        return BinaryFeature(value=bool(value))
+
+
+class RatioColumn(FeatureColumn):
+    """A positive number compared by ratio: min(own, other) / max(own, other), e.g. income"""
+
+    def __init__(self, name, low, high):
+        """:param low: smallest value of a new agent
+        :param high: largest value of a new agent"""
+        super().__init__(name)
+        self.low = low
+        self.high = high
+
+    def matches(self, own, other, preference_matrix=None):
+        own = np.asarray(own, dtype=float)
+        other = np.asarray(other, dtype=float)
+        low, high = np.minimum(own, other), np.maximum(own, other)
+        return np.divide(low, high, out=np.zeros_like(low), where=high > 0)
+
+    def neighbor_matches(self, values, agents, radius, weighted=False, kind=MOORE, preference_matrix=None):
+        return income_ratio_sum(values, agents, radius, weighted, kind)
+
+    def random(self, rng, shape):
+        return rng.integers(self.low, self.high, shape, endpoint=True)
+
+
+class ThresholdColumn(FeatureColumn):
+    """A number, a neighbor is liked if its value differs by less than the threshold, e.g. age"""
+
+    def __init__(self, name, threshold, low, high):
+        """:param low: smallest value of a new agent
+        :param high: largest value of a new agent"""
+        super().__init__(name)
+        self.threshold = threshold
+        self.low = low
+        self.high = high
+
+    def matches(self, own, other, preference_matrix=None):
+        return np.abs(np.asarray(other, dtype=float) - np.asarray(own, dtype=float)) < self.threshold
+
+    def random(self, rng, shape):
+        return rng.integers(self.low, self.high, shape, endpoint=True)
+
+    def wrap(self, value):
+        return RealNumberFeature(value=float(value), threshold=self.threshold)
+
+
+# The features every city has, in the order of weight_list. Religion uses the city's preference matrix
+registry = [CategoricalColumn("religion"), BinaryColumn("ethnicity"), RatioColumn("income", min_income, max_income)]
+builtin_count = len(registry)
+
+
+def register(feature):
+    """Add a feature after the ones registered so far, its weight comes next in weight_list
+    :return the feature"""
+    if any(other.name == feature.name for other in registry):
+        raise ValueError(f"A feature named {feature.name!r} is already registered")
+    registry.append(feature)
+    return feature
+
+
+def extra_features():
+    """The registered features beyond religion, ethnicity and income"""
+    return registry[builtin_count:]
+
+
+def feature_weights(weights):
+    """The weights for every registered feature, 0 for the ones weights has no value for"""
+    weights = list(weights)
+    return weights + [0] * (len(registry) - len(weights))
+
+
+# Register more features here, see the top of this file
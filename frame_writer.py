@@ -0,0 +1,53 @@
+import os
+
+from PIL import GifImagePlugin
+
+
+class GifStreamWriter:
+    """Writes an animated GIF to disk one frame at a time, so frames don't have to be kept in memory
+    until the end of the simulation. Every frame is quantized separately and gets its own color table."""
+
+    def __init__(self, path, duration=200, loop=1, resume_at=0):
+        """:param path: file to write
+        :param duration: time each frame is shown, in milliseconds
+        :param loop: number of times the animation repeats
+        :param resume_at: continue a gif written earlier, cutting it off at this size (see tell)"""
+        self.duration = duration
+        self.loop = loop
+        # Whether the gif header has been written
+        self.started = False
+        if resume_at and os.path.exists(path) and os.path.getsize(path) >= resume_at:
+            self.file = open(path, "r+b")
+            self.file.truncate(resume_at)
+            self.file.seek(resume_at)
+            self.started = True
+        else:
+            self.file = open(path, "wb")
+
+    def tell(self):
+        """Size of the file up to the last frame written"""
+        return self.file.tell()
+
+    def write(self, image):
+        """Encode a frame (any PIL image) and append it to the file"""
+        frame = image.convert("RGB").quantize(256)
+        if not self.started:
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": self.loop, "duration": self.duration})
+            for chunk in header:
+                self.file.write(chunk)
+        for chunk in GifImagePlugin.getdata(frame, duration=self.duration, include_color_table=True):
+            self.file.write(chunk)
+        self.file.flush()
+        self.started = True
+
+    def close(self):
+        if self.started:
+            # GIF trailer
+            self.file.write(b";")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
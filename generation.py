@@ -0,0 +1,82 @@
+import numpy as np
+
+from city_arrays import CityArrays
+from features import extra_features
+from params import *
+
+
+def segregate_prices(price, max_price, price_segregation):
+    """Move all prices toward 0 and max_price a bit, depending on which they are closer to
+    Do a weighted average - price_segregation is the weight of the endpoints"""
+    return np.where(price < max_price / 2, price / (1 + price_segregation),
+                    (price + max_price * price_segregation) / (1 + price_segregation))
+
+
+def price_field(rng, w, h, min_price, max_price, price_noise, price_segregation, replicates=None):
+    """House prices of a (w + 2) x (h + 2) city, generated like city.generate_city does: every house gets the
+    average of 6 houses generated before it plus noise, starting from random prices around the edges.
+    With replicates, that many independent cities are generated at once, along a leading axis.
+
+    A house at (x, y) depends on (x, y - 1), (x, y - 2), (x - 1, y), (x - 2, y), (x - 1, y + 1) and
+    (x - 2, y + 1), which all have a smaller 2x + y, so every anti-diagonal wavefront 2x + y = t can be
+    computed at once from the ones before it."""
+    lead = () if replicates is None else (replicates,)
+
+    def random_prices(shape):
+        return segregate_prices(rng.integers(min_price, max_price, lead + shape, endpoint=True).astype(float),
+                                max_price, price_segregation)
+
+    # prices[..., x + 2, y + 2] is the price at (x, y), for x in [-2, w) and y in [-2, h]
+    prices = random_prices((w + 2, h + 3))
+    noise = price_noise * max_price
+    for t in range(0, 2 * (w - 1) + h):
+        xs = np.arange(max(0, (t - h + 2) // 2), min(w - 1, t // 2) + 1)
+        ys = t - 2 * xs
+        px, py = xs + 2, ys + 2
+        price = (prices[..., px, py - 1] + prices[..., px, py - 2] + prices[..., px - 1, py]
+                 + prices[..., px - 2, py] + prices[..., px - 1, py + 1] + prices[..., px - 2, py + 1]) / 6
+        price = price + rng.integers(int(-noise), int(noise), lead + (len(xs),), endpoint=True)
+        # Noise may have made price above max, limit it to the [0, max_price] interval
+        prices[..., px, py] = segregate_prices(np.clip(price, 0, max_price), max_price, price_segregation)
+
+    # The padding rows and columns get prices of their own, that were not used for the city
+    grid = random_prices((w + 2, h + 2))
+    grid[..., :w, :h] = prices[..., 2:, 2:h + 2]
+    return grid
+
+
+def generate_city_arrays(w=w, h=h, weights=weight_list, empty_ratio=empty_ratio, landmark_ratio=landmark_ratio,
+                         min_price=min_price, max_price=max_price, price_noise=price_noise,
+                         price_segregation=price_segregation, min_income=min_income, max_income=max_income,
+                         method="vectorized", rng=None, replicates=None):
+    """Generate a random city with the same distribution as city.generate_city, using array operations
+    :param method: "vectorized", or "reference" to build it with city.generate_city and convert it
+    :param rng: numpy random Generator to draw from, a new unseeded one if None
+    :param replicates: generate this many independent cities at once, stacked along a leading axis of
+    every layer (vectorized method only)
+    :return CityArrays"""
+    if rng is None:
+        rng = np.random.default_rng()
+    settings = dict(w=w, h=h, weights=weights, empty_ratio=empty_ratio, landmark_ratio=landmark_ratio,
+                    min_price=min_price, max_price=max_price, price_noise=price_noise,
+                    price_segregation=price_segregation, min_income=min_income, max_income=max_income)
+    if method == "reference" and replicates is None:
+        from city import generate_city
+        return CityArrays.from_object_grid(generate_city(**settings, rng=rng), weights=weights)
+    if method != "vectorized":
+        raise ValueError(f"Unknown generation method {method!r}")
+
+    shape = (w + 2, h + 2) if replicates is None else (replicates, w + 2, h + 2)
+    city = CityArrays(shape, weights=weights)
+    city.price[...] = price_field(rng, w, h, min_price, max_price, price_noise, price_segregation, replicates)
+    # 1 in 10 probability of an empty house, 1 in 100 for a landmark. Landmark takes priority over empty
+    city.landmark[...] = rng.integers(1, round(1 / landmark_ratio), shape, endpoint=True) == 1
+    city.empty[...] = (rng.integers(1, round(1 / empty_ratio), shape, endpoint=True) == 1) & ~city.landmark
+    # Agents and landmarks both get a random religion
+    city.religion[...] = np.where(city.empty, 0, rng.integers(1, 5, shape, endpoint=True))
+    agents = city.occupied
+    city.ethnicity[...] = agents & (rng.integers(1, 2, shape, endpoint=True) == 1)
+    city.income[...] = np.where(agents, rng.integers(min_income, max_income, shape, endpoint=True), 0)
+    for feature in extra_features():
+        getattr(city, feature.name)[...] = np.where(agents, feature.random(rng, shape), 0)
+    return city
@@ -0,0 +1,114 @@
+import cProfile
+import json
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+
+class _PhaseTimer:
+    """Context manager that adds the time (and optionally the memory) of one pass through a phase to the
+    totals of the current step"""
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        if self.instruments.track_memory:
+            tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        phase = self.instruments.phases.setdefault(self.name, {"seconds": 0.0, "calls": 0})
+        phase["seconds"] += seconds
+        phase["calls"] += 1
+        if self.instruments.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            phase["allocated"] = phase.get("allocated", 0) + current - self.memory
+            phase["peak"] = max(phase.get("peak", 0), peak - self.memory)
+
+
+class Instrumentation:
+    """Times the phases of every iteration of the main loop and writes one JSON line per iteration.
+
+    A line holds the step number, the seconds and number of calls of each phase, the number of moves
+    (the Instrumentation is an observer of time_step) and any counts passed to end_step. With
+    track_memory, the bytes allocated and the peak above the start of each phase are added, from
+    tracemalloc. When disabled, phase() returns a shared context manager that does nothing, so the hooks
+    can stay in the loop."""
+
+    def __init__(self, path=None, enabled=True, track_memory=False, profile_steps=None, profile_path=None):
+        """:param path: file to write the JSON lines to
+        :param enabled: False to turn every hook into a no-op
+        :param track_memory: also record allocations per phase, this slows everything down a lot
+        :param profile_steps: (first, last) step of a window to run cProfile and tracemalloc on, or None
+        :param profile_path: where the window's profile is saved (.prof, for pstats or snakeviz), the top
+        allocations are saved next to it with .txt appended"""
+        self.enabled = enabled
+        self.track_memory = enabled and track_memory
+        self.profile_steps = profile_steps if enabled else None
+        self.profile_path = profile_path
+        self.log = open(path, "a") if enabled and path else None
+        self.timers = {}
+        self.phases = {}
+        self.moves = 0
+        self.step = None
+        self.profiler = None
+        self._idle = nullcontext()
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def phase(self, name):
+        """Context manager around one phase of an iteration, e.g. `with instruments.phase("render"):`"""
+        if not self.enabled:
+            return self._idle
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = _PhaseTimer(self, name)
+        return timer
+
+    def move(self, src, dst):
+        self.moves += 1
+
+    def start_step(self, i):
+        """Called at the start of iteration i, starts the profile when the window begins"""
+        if not self.enabled:
+            return
+        self.step = i
+        if self.profile_steps and i == self.profile_steps[0] and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.profiler.enable()
+
+    def end_step(self, **counts):
+        """Called at the end of an iteration, writes its line and ends the profile when the window ends
+        :param counts: extra values to log, e.g. the number of unsatisfied agents"""
+        if not self.enabled:
+            return
+        if self.log is not None:
+            self.log.write(json.dumps({"step": self.step, "phases": self.phases, "moves": self.moves, **counts}))
+            self.log.write("\n")
+        self.phases = {}
+        self.moves = 0
+        if self.profiler is not None and self.step >= self.profile_steps[1]:
+            self._save_profile()
+
+    def _save_profile(self):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.profile_path)
+        with open(self.profile_path + ".txt", "w") as file:
+            for stat in tracemalloc.take_snapshot().statistics("lineno")[:30]:
+                file.write(f"{stat}\n")
+        if not self.track_memory:
+            tracemalloc.stop()
+        self.profiler = None
+
+    def close(self):
+        """Save a profile whose window was not finished (e.g. the run stopped early) and close the log"""
+        if self.profiler is not None:
+            self._save_profile()
+        if self.log is not None:
+            self.log.close()
@@ -1,44 +1,84 @@
-import random
-import sys
-from enum import Enum, auto
-
 import numpy as np
 
+from agent import CategoricalFeature
+from neighborhood import dilate
+from params import landmark_decay, landmark_radius, neighborhood_shape
 
-class Religion(Enum):
-    IRRELIGIOUS = 1
-    ROMAN_CATHOLIC = 2
-    DUTCH_REFORMED = 3
-    PROTESTANT = 4
-    REFORMED_CHURCHES = 5
-    MUSLIM = 6
-    HINDU = 7
-    JEWISH = 8
-    BUDDHIST = 9
 
+class Landmark:
 
-# How much each religion likes each other religion
-religion_preference_matrix = np.identity(9, dtype=float)
+    def __init__(self, religion: CategoricalFeature, landmark):
+        self.religion = religion
+        self.landmark = landmark
 
 
-# When a feature is an unordered category (e.g. religion, ethnicity)
-class CategoricalFeature:
-    categories: Enum
+def apply_influence(satisfaction, influence):
+    """Religion satisfaction raised to the influence of landmarks where there is any. A satisfaction that
+    is NaN (no neighbors) stays NaN when no landmark is in reach
+    :param satisfaction: array of religion satisfactions
+    :param influence: array of influences, from LandmarkIndex.influence"""
+    return np.where(influence > 0, np.fmax(satisfaction, influence), satisfaction)
 
-    def __init__(self, value, preference_matrix, threshold=0.5):
-        self.value = value
-        self.preference_matrix = preference_matrix
-        self.threshold = threshold
 
-    def preference(self, other):
-        # Compare the agent's own religion value to a neighbor and check whether it passes the threshold
-        return self.preference_matrix[self.value][other.value] > self.threshold
+class LandmarkIndex:
+    """For every religion and every home, the distance to the nearest landmark of a religion it likes, so the
+    landmark rule of satisfaction is one array lookup instead of a scan of the neighbors.
 
+    A landmark within `radius` of an agent raises its religion satisfaction to the landmark's influence,
+    decay ** (distance - 1): 1 next to it, and less further away if decay is below 1. Landmarks never move,
+    so the index is built once for a city, by growing the landmarks of each religion one ring at a time."""
 
-class Landmark:
+    def __init__(self, nearest, strengths):
+        """:param nearest: array of shape (religions,) + city shape, nearest[r, x, y] is the distance from
+        (x, y) to the nearest landmark that religion r likes, or len(strengths) - 1 if there is none in reach
+        :param strengths: the influence of a landmark at each distance, 0 for none in reach"""
+        self.nearest = nearest
+        self.strengths = strengths
 
-    def __init__(self, religion: CategoricalFeature, landmark):
-        self.religion = religion
-        self.landmark = landmark
+    @classmethod
+    def from_city(cls, city, neighborhood_radius, kind=neighborhood_shape, radius=landmark_radius,
+                  decay=landmark_decay, threshold=0.5):
+        """Index the landmarks of a CityArrays (or an object grid), its layers may have leading axes
+        :param neighborhood_radius: the radius agents look at for neighbors
+        :param kind: shape of the neighborhood, distances are measured the same way
+        :param radius: how far a landmark reaches, None for the neighborhood radius
+        :param decay: how much the influence of a landmark drops with every step of distance
+        :param threshold: a religion likes another if its preference is above this"""
+        # city_arrays imports this module through compact.py, so it can only be imported here
+        from city_arrays import CityArrays
+
+        if not isinstance(city, CityArrays):
+            city = CityArrays.from_object_grid(city)
+        if radius is None:
+            radius = neighborhood_radius
+        accept = city.preference_matrix > threshold
+        religion = city.religion.astype(np.intp)
+        # One past the radius means out of reach
+        nearest = np.full((len(accept),) + city.shape, radius + 1, dtype=np.min_scalar_type(radius + 1))
+        for category in np.unique(religion[city.landmark]).tolist():
+            reached = city.landmark & (religion == category)
+            distance = np.full(city.shape, radius + 1, dtype=nearest.dtype)
+            for d in range(1, radius + 1):
+                reached = dilate(reached, kind)
+                distance[reached & (distance > d)] = d
+            for own in np.flatnonzero(accept[:, category]):
+                np.minimum(nearest[own], distance, out=nearest[own])
+        strengths = np.zeros(radius + 2)
+        strengths[1:-1] = float(decay) ** np.arange(radius)
+        return cls(nearest, strengths)
+
+    def influence(self, religion, *cell):
+        """How much the landmarks raise the religion satisfaction of agents of a religion in cells
+        :param religion: religion codes, or slice(None) for every religion
+        :param cell: index arrays of the cells, one per axis of the city
+        :return array of influences from 0 to 1"""
+        return self.strengths[self.nearest[(religion,) + cell]]
 
+    def influence_grid(self, religion):
+        """influence for every cell of the city, of the religion in religion (a layer of religion codes)"""
+        nearest = np.take_along_axis(self.nearest, religion.astype(np.intp)[None], axis=0)[0]
+        return self.strengths[nearest]
 
+    def row_band(self, start, stop):
+        """The index of rows start:stop, for CityArrays.row_band"""
+        return LandmarkIndex(self.nearest[:, start:stop], self.strengths)
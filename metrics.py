@@ -0,0 +1,94 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from city_arrays import CityArrays
+
+
+class Metric:
+    """A value that is sampled from the city every few steps"""
+
+    def __init__(self, name, function, every=1, background=False):
+        """:param name: name of the history the values are kept in
+        :param function: called with the city, returns the value
+        :param every: sample at every step that is a multiple of this
+        :param background: compute it in a worker process from a copy of the city's arrays, so the
+        simulation doesn't wait for it. The function must then be picklable (defined at module level)
+        and accept a CityArrays"""
+        self.name = name
+        self.function = function
+        self.every = every
+        self.background = background
+
+
+class MetricsScheduler:
+    """Samples each metric at its own interval instead of every step, optionally in the background.
+
+    It keeps a CityArrays copy of the city up to date as an observer of time_step. Background metrics get
+    a snapshot of it, which is only a copy of a few arrays, and are computed in a pool of worker processes
+    while the simulation goes on. Values are kept per metric as [step, value] pairs in step order."""
+
+    def __init__(self, city, metrics, workers=1, histories=None):
+        """:param city: object grid or CityArrays
+        :param metrics: list of Metric
+        :param workers: number of worker processes for the background metrics
+        :param histories: dict of metric name to the [step, value] pairs sampled so far, e.g. from a checkpoint"""
+        self.arrays = city.copy() if isinstance(city, CityArrays) else CityArrays.from_object_grid(city)
+        self.metrics = metrics
+        self.history = {metric.name: [[int(i), value] for i, value in (histories or {}).get(metric.name, [])]
+                        for metric in metrics}
+        self.pending = []
+        self.pool = ProcessPoolExecutor(workers) if any(metric.background for metric in metrics) else None
+
+    def move(self, src, dst):
+        self.arrays.move(src, dst)
+
+    def sample(self, i, city=None, force=False):
+        """Sample the metrics that are due at step i
+        :param city: the grid the foreground metrics are computed on, by default the CityArrays kept up to
+        date by move, so they don't convert the object grid every time
+        :param force: sample every metric, e.g. at the last step"""
+        if city is None:
+            city = self.arrays
+        snapshot = None
+        for metric in self.metrics:
+            if not (force or i % metric.every == 0):
+                continue
+            if self.history[metric.name] and self.history[metric.name][-1][0] == i:
+                continue
+            if metric.background:
+                if snapshot is None:
+                    snapshot = self.arrays.copy()
+                self.pending.append((metric.name, i, self.pool.submit(metric.function, snapshot)))
+            else:
+                self.history[metric.name].append([i, metric.function(city)])
+        self.collect()
+
+    def collect(self, wait=False):
+        """Move the finished background values into the histories
+        :param wait: wait for all of them to finish"""
+        still_pending = []
+        for name, i, future in self.pending:
+            if wait or future.done():
+                self.history[name].append([i, future.result()])
+            else:
+                still_pending.append((name, i, future))
+        self.pending = still_pending
+        for values in self.history.values():
+            values.sort(key=lambda pair: pair[0])
+
+    def histories(self):
+        """All values sampled so far, after waiting for the background ones
+        :return dict of metric name to list of [step, value] pairs"""
+        self.collect(wait=True)
+        return self.history
+
+    def steps(self, name):
+        return [i for i, value in self.history[name]]
+
+    def values(self, name):
+        return [value for i, value in self.history[name]]
+
+    def close(self):
+        """Wait for the background metrics and stop the workers"""
+        self.collect(wait=True)
+        if self.pool is not None:
+            self.pool.shutdown()
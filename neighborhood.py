@@ -0,0 +1,156 @@
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+# Shapes of neighborhoods, by the distance used to decide whether a house is within the radius
+MOORE = "moore"  # chebyshev distance, a square window
+VON_NEUMANN = "von_neumann"  # manhattan distance, a diamond
+
+
+def distance(di, dj, kind=MOORE):
+    if kind == MOORE:
+        return max(abs(di), abs(dj))
+    if kind == VON_NEUMANN:
+        return abs(di) + abs(dj)
+    raise ValueError(f"Unknown neighborhood shape {kind!r}")
+
+
+@lru_cache(maxsize=None)
+def offsets(radius, weighted=False, kind=MOORE):
+    """The (di, dj) offsets of the neighbors of a house, in the order city.neighbors visits them.
+    The house itself is left out. If weighted, the window of every radius 1..radius is visited in turn, so
+    a neighbor at distance d appears radius - d + 1 times (like city.neighbors_weighted)
+    :return tuple of (di, dj) pairs"""
+    rings = range(1, radius + 1) if weighted else [radius]
+    result = []
+    for r in rings:
+        for di in range(-r, r + 1):
+            for dj in range(-r, r + 1):
+                if 0 < distance(di, dj, kind) <= r:
+                    result.append((di, dj))
+    return tuple(result)
+
+
+@lru_cache(maxsize=None)
+def offset_counts(radius, weighted=False, kind=MOORE):
+    """The distinct offsets of a neighborhood with how many times each is counted
+    :return tuple of (di, dj, count)"""
+    counts = Counter(offsets(radius, weighted, kind))
+    return tuple((di, dj, count) for (di, dj), count in counts.items())
+
+
+@lru_cache(maxsize=32)
+def neighbor_table(shape, radius, weighted=False, kind=MOORE):
+    """Flat indices of the neighbors of every house of a grid, in compressed sparse row form.
+    Built once per grid shape and neighborhood, houses on the edge of the grid (including the padding)
+    simply have fewer neighbors.
+    :param shape: (rows, columns) of the grid
+    :return (indptr, indices): the neighbors of the house with flat index k are
+    indices[indptr[k]:indptr[k + 1]]"""
+    rows, cols = shape
+    x, y = np.divmod(np.arange(rows * cols), cols)
+    candidates = []
+    valid = []
+    for di, dj in offsets(radius, weighted, kind):
+        candidates.append((x + di) * cols + (y + dj))
+        valid.append((0 <= x + di) & (x + di < rows) & (0 <= y + dj) & (y + dj < cols))
+    if not candidates:
+        return np.zeros(rows * cols + 1, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    candidates = np.stack(candidates, axis=1)
+    valid = np.stack(valid, axis=1)
+    indices = candidates[valid]
+    indptr = np.zeros(rows * cols + 1, dtype=np.intp)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+    # The table is shared, don't let callers change it by accident
+    indptr.setflags(write=False)
+    indices.setflags(write=False)
+    return indptr, indices
+
+
+def neighbor_cells(shape, radius, x, y, weighted=False, kind=MOORE):
+    """The (i, j) coordinates of the neighbors of house (x, y)"""
+    indptr, indices = neighbor_table(tuple(shape), radius, weighted, kind)
+    cell = x * shape[1] + y
+    return zip(*np.divmod(indices[indptr[cell]:indptr[cell + 1]], shape[1]))
+
+
+def _window_sum(layer, r):
+    """Sum of each (2r+1)x(2r+1) window over the last two axes, cells outside the grid count as 0"""
+    pad = [(0, 0)] * (layer.ndim - 2) + [(r + 1, r), (r + 1, r)]
+    table = np.pad(layer, pad).cumsum(axis=-2).cumsum(axis=-1)
+    size = 2 * r + 1
+    return table[..., size:, size:] - table[..., :-size, size:] - table[..., size:, :-size] \
+        + table[..., :-size, :-size]
+
+
+def neighbor_sum(layer, radius, weighted=False, kind=MOORE):
+    """For every cell, the sum of a layer over its neighbors, matching city.neighbors
+    (or city.neighbors_weighted, where a neighbor at distance d is counted radius - d + 1 times)
+    :param layer: array whose last two axes are the city grid
+    :param radius: maximum distance to include
+    :param weighted: whether closer neighbors are counted multiple times
+    :param kind: shape of the neighborhood, MOORE or VON_NEUMANN
+    :return array of the same shape as layer"""
+    if kind != MOORE:
+        total = 0
+        for di, dj, count in offset_counts(radius, weighted, kind):
+            total = total + count * shifted(layer, di, dj)
+        return total
+    # Square windows can be summed from a cumulative sum table, whatever their size
+    rings = range(1, radius + 1) if weighted else [radius]
+    total = 0
+    for r in rings:
+        total = total + _window_sum(layer, r) - layer
+    return total
+
+
+def shifted(layer, di, dj, fill=0):
+    """shifted(a, di, dj)[x, y] == a[x + di, y + dj], with fill where that is outside the grid"""
+    result = np.full_like(layer, fill)
+    rows, cols = layer.shape[-2:]
+    dst_x = slice(max(-di, 0), rows - max(di, 0))
+    dst_y = slice(max(-dj, 0), cols - max(dj, 0))
+    src_x = slice(max(di, 0), rows - max(-di, 0))
+    src_y = slice(max(dj, 0), cols - max(-dj, 0))
+    result[..., dst_x, dst_y] = layer[..., src_x, src_y]
+    return result
+
+
+def dilate(mask, kind=MOORE):
+    """A boolean mask grown by one step of distance: the masked cells and their neighbors at radius 1,
+    over the last two axes"""
+    result = mask.copy()
+    for di, dj in offsets(1, kind=kind):
+        result |= shifted(mask, di, dj, fill=False)
+    return result
+
+
+def income_ratio_sum(income, agents, radius, weighted=False, kind=MOORE):
+    """For every cell, the sum over its agent neighbors of min(income, neighbor)/max(income, neighbor)"""
+    income = income.astype(float)
+    total = np.zeros(income.shape)
+    for di, dj, count in offset_counts(radius, weighted, kind):
+        other = shifted(income, di, dj)
+        present = shifted(agents, di, dj, fill=False)
+        low = np.minimum(income, other)
+        high = np.maximum(income, other)
+        ratio = np.divide(low, high, out=np.zeros_like(low), where=present & (high > 0))
+        total += count * ratio
+    return total
+
+
+def category_match_sum(values, mask, own_values, accept, radius, weighted=False, kind=MOORE):
+    """For every cell, how many masked neighbors have a category that the cell's own category accepts
+    :param values: category code of every cell
+    :param mask: which cells take part as neighbors
+    :param own_values: category code of the cell doing the comparing
+    :param accept: boolean matrix, accept[own][other] is True if own likes other
+    :return array of neighbor counts"""
+    total = np.zeros(values.shape)
+    for category in np.unique(values[mask]):
+        liked = accept[own_values, category]
+        if not liked.any():
+            continue
+        total += liked * neighbor_sum((mask & (values == category)).astype(np.int64), radius, weighted, kind)
+    return total
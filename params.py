@@ -1,3 +1,6 @@
+# Seed of the random generator, None for a different city every run
+seed = None
+
 # Max iterations
 max_iterations = 100
 # Simulation stop
@@ -10,6 +13,11 @@ w, h = 16,  16
 min_price = 10000
 max_price = 1000000
 
+# How the city is generated, "vectorized" (array operations) or "reference" (house by house, slow for big grids)
+generation_method = "vectorized"
+# Build the grid of houses from the slotted classes with shared features of compact.py, which use less memory
+compact_objects = False
+
 # Min/max income of residents
 min_income = 100
 max_income = 100000
@@ -21,7 +29,8 @@ price_noise = 0.3
 # weight of extreme prices, if 0 prices will be evenly distributed
 price_segregation = 0.1
 
-# Importance of religion, ethnicity and income respectively for each agent
+# Importance of religion, ethnicity and income respectively for each agent, followed by the importance of
+# any features registered in features.py
 weight_list = [1, 0, 0]
 
 # Ratio of empty houses
@@ -30,11 +39,49 @@ empty_ratio = 0.1
 # Ratio of landmarks
 landmark_ratio = 0.01
 
+# Save a checkpoint every N steps to continue from with `python city.py --resume <file>`, 0 for none
+checkpoint_every = 0
+
+# Record every move to a trajectory on disk, so any step can be looked at afterwards
+record_trajectory = False
+
+# Log the time of every phase of each step (rendering, metrics, the step itself) to instrumentation.jsonl
+instrument = False
+# Also log the memory allocated by every phase, this makes the run much slower
+instrument_memory = False
+# (first, last) step to run cProfile and tracemalloc on, saved to profile.prof and profile.prof.txt, or None
+profile_steps = None
+
+# Compute the income comparison every N steps and the cluster counts every M steps
+income_every = 1
+cluster_every = 1
+# Compute the income comparison in a worker process from a copy of the city, while the simulation goes on
+metrics_in_background = False
+
+# Only every Nth step is drawn into the gifs
+frame_every = 1
+
 # how much to zoom in on the picture before displaying, please use integer for good results
 zoom = 10
 
 # The radius that agents look at for neighbors
 radius = 1
 
+# Shape of the neighborhood within the radius, "moore" (square) or "von_neumann" (diamond)
+neighborhood_shape = "moore"
+
+# How far a landmark raises the religion satisfaction of agents of a religion that likes it, None for the radius
+landmark_radius = None
+# Influence of a landmark at distance d is landmark_decay ** (d - 1), 1 for full influence within landmark_radius
+landmark_decay = 1
+
+# How unsatisfied agents move in a step: "sequential" (one at a time in grid order), "synchronous" (all at once)
+# or "random_sequential" (in random order, in batches). The last two are much faster on big grids
+update_mode = "sequential"
+
 # Whether an agent checks their future neighbors before moving to a house
 check_future_home = False
+
+# In a sequential step, update the satisfaction of agents move by move only while at most this ratio of them is
+# unsatisfied, otherwise visit every agent and recompute all satisfactions after the step
+cache_scan_ratio = 0.1
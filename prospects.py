@@ -0,0 +1,116 @@
+import numpy as np
+
+from landmark import apply_influence
+from vacancies import VacancyIndex
+
+
+class ProspectIndex:
+    """For every type of agent (religion and ethnicity), the empty homes it could be satisfied in, so an
+    unsatisfied agent can pick one at random without checking every empty home.
+
+    Whether a home is acceptable only depends on the neighborhood sums that the SatisfactionCache already
+    keeps for every cell, except for the income part, which depends on the agent's own income. The index
+    counts the income part, and that of any feature registered in features.py, as fully satisfied, so it
+    holds every acceptable home and maybe some more.
+    Homes are drawn from it at random and checked exactly with the cache, which makes the pick uniform
+    among the acceptable homes. Homes near the agent's own are added to the draw, since the agent leaving
+    changes their neighbors. When most draws fail, all candidates are checked at once.
+
+    It is kept up to date by move(src, dst), which must be called after the cache's move."""
+
+    def __init__(self, cache, vacancies, max_tries=16, members=None):
+        """:param cache: SatisfactionCache of the city
+        :param vacancies: VacancyIndex of the empty homes
+        :param max_tries: random draws before falling back to checking all candidates
+        :param members: dict of (religion, ethnicity) to a list of homes, to continue from (e.g. from a
+        checkpoint) instead of building the index, so draws pick the same homes"""
+        self.cache = cache
+        self.max_tries = max_tries
+        self.vacant = np.zeros(cache.shape, dtype=bool)
+        cells = np.array(vacancies.cells, dtype=np.intp).reshape(-1, 2)
+        self.vacant[cells[:, 0], cells[:, 1]] = True
+        self.types = [(religion, ethnicity) for religion in range(len(cache.accept)) for ethnicity in (0, 1)]
+        self.member = np.zeros((len(cache.accept), 2) + cache.shape, dtype=bool)
+        if members is not None:
+            self.members = {key: VacancyIndex(members.get(key, [])) for key in self.types}
+            for (religion, ethnicity), index in self.members.items():
+                for cell in index:
+                    self.member[(religion, ethnicity) + cell] = True
+            return
+        self.members = {key: VacancyIndex() for key in self.types}
+        acceptable = self._acceptable(cells[:, 0], cells[:, 1])
+        for religion, ethnicity in self.types:
+            for x, y in cells[acceptable[religion, ethnicity]].tolist():
+                self.members[religion, ethnicity].add((x, y))
+                self.member[religion, ethnicity, x, y] = True
+
+    def _acceptable(self, xs, ys):
+        """Whether each type of agent could be satisfied in the homes at xs, ys, with the most it could get
+        from income and the registered features
+        :return boolean array indexed by religion, ethnicity and home"""
+        cache = self.cache
+        weights = cache.weights
+        count = cache.count[xs, ys]
+        no_neighbors = count == 0
+        safe_count = np.where(no_neighbors, 1, count)
+        religion = np.zeros((len(cache.accept), len(xs)))
+        ethnicity = np.zeros((2, len(xs)))
+        income = 0
+        # The income and registered features are counted as fully satisfied
+        others = sum(weights[2:])
+        if weights[0] != 0:
+            religion = np.where(no_neighbors, np.nan,
+                                cache.accept.astype(float) @ cache.religion_counts[:, xs, ys] / safe_count)
+        if weights[1] != 0:
+            ethnicity = np.where(no_neighbors, np.nan, cache.ethnicity_counts[:, xs, ys] / safe_count)
+        if others != 0:
+            income = np.where(no_neighbors, np.nan, others)
+        religion = apply_influence(religion, cache.landmarks.influence(slice(None), xs, ys))
+        best = (weights[0] * religion[:, None] + weights[1] * ethnicity[None] + income) / sum(weights)
+        return best > cache.threshold
+
+    def _update(self, xs, ys):
+        """Bring the membership of the homes at xs, ys up to date"""
+        acceptable = self._acceptable(xs, ys) & self.vacant[xs, ys]
+        changed = np.nonzero(acceptable != self.member[:, :, xs, ys])
+        for religion, ethnicity, k in zip(*(axis.tolist() for axis in changed)):
+            cell = (int(xs[k]), int(ys[k]))
+            if acceptable[religion, ethnicity, k]:
+                self.members[religion, ethnicity].add(cell)
+            else:
+                self.members[religion, ethnicity].remove(cell)
+            self.member[religion, ethnicity][cell] = acceptable[religion, ethnicity, k]
+
+    def move(self, src, dst):
+        """Record that the agent at src moved into the empty home at dst, after cache.move(src, dst)"""
+        self.vacant[src] = True
+        self.vacant[dst] = False
+        old_xs, old_ys, _ = self.cache._neighborhood(src)
+        new_xs, new_ys, _ = self.cache._neighborhood(dst)
+        xs = np.concatenate([old_xs, new_xs, [src[0], dst[0]]])
+        ys = np.concatenate([old_ys, new_ys, [src[1], dst[1]]])
+        cells = np.unique(np.ravel_multi_index((xs, ys), self.cache.shape))
+        self._update(*np.unravel_index(cells, self.cache.shape))
+
+    def sample(self, src, rng):
+        """A uniformly random empty home that the agent living at src would be satisfied in
+        :param rng: numpy random Generator
+        :return (x, y) of the home, or None if there is none"""
+        cache = self.cache
+        members = self.members[cache.religion[src], cache.ethnicity[src]]
+        xs, ys, _ = cache._neighborhood(src)
+        near = [cell for cell in zip(xs.tolist(), ys.tolist()) if self.vacant[cell] and cell not in members]
+        candidates = len(members) + len(near)
+        if not candidates:
+            return None
+        for _ in range(self.max_tries):
+            k = int(rng.integers(candidates))
+            cell = members.cells[k] if k < len(members) else near[k - len(members)]
+            if cache.prospect(src, cell) > cache.threshold:
+                return cell
+        # Acceptable homes are rare among the candidates, check them all at once
+        cells = members.cells + near
+        acceptable = np.flatnonzero(cache.prospects(src, cells) > cache.threshold)
+        if not len(acceptable):
+            return None
+        return cells[acceptable[rng.integers(len(acceptable))]]
@@ -0,0 +1,81 @@
+import colorsys
+
+import numpy as np
+from PIL import Image
+
+from city_arrays import CityArrays
+from params import min_income, max_income, zoom as default_zoom
+
+# Colors of the frames, the same as the old scatter plots used
+BACKGROUND = (255, 255, 255)
+EMPTY = (0, 0, 0)
+LANDMARK = (0, 128, 0)
+# Ethnicity is binary for now, indexed by the ethnicity value
+ETHNICITY_COLORS = np.array([(0, 0, 255), (255, 0, 0)], dtype=np.uint8)
+total_religions = 5
+
+
+def religion_colors(categories):
+    """Lookup table with a unique color for every religion code"""
+    table = np.zeros((categories, 3), dtype=np.uint8)
+    for religion in range(categories):
+        rc, gc, bc = colorsys.hls_to_rgb(religion / total_religions, 0.4, 1)
+        table[religion] = (int(rc * 255), int(gc * 255), int(bc * 255))
+    return table
+
+
+def income_colors(income):
+    """From white for the highest income to magenta for the lowest"""
+    # equation of a line through 2 points (min_income, 0) and (max_income,255)
+    color = ((income - min_income) * 255 / (max_income - min_income)).astype(np.int64).clip(0, 255)
+    rgb = np.full(income.shape + (3,), 255, dtype=np.uint8)
+    rgb[..., 1] = color
+    return rgb
+
+
+def triangle(size):
+    """Mask of an upward triangle filling a size x size square, used as the landmark marker"""
+    rows, cols = np.mgrid[0:size, 0:size]
+    return np.abs(cols - (size - 1) / 2) <= (rows + 1) / 2
+
+
+def to_image(colors, markers, zoom=default_zoom):
+    """Turn an (x, y) grid of colors into an image, x to the right and y upwards like the scatter plots.
+    Every cell becomes a zoom x zoom square, cells in markers become a triangle
+    :param colors: array of shape (columns, rows, 3)
+    :param markers: boolean array of shape (columns, rows)"""
+    colors = colors.transpose(1, 0, 2)[::-1]
+    markers = markers.T[::-1]
+    pixels = colors.repeat(zoom, axis=0).repeat(zoom, axis=1)
+    if zoom > 2:
+        outside = markers.repeat(zoom, axis=0).repeat(zoom, axis=1) & \
+                  np.tile(~triangle(zoom), markers.shape)
+        pixels[outside] = BACKGROUND
+    return Image.fromarray(np.ascontiguousarray(pixels), 'RGB')
+
+
+def render_frames(city, zoom=default_zoom):
+    """Draw the religion, ethnicity and income maps of a city straight from its arrays, without matplotlib
+    :param city: a CityArrays (an object grid is converted first)
+    :param zoom: size in pixels of one house
+    :return tuple of religion, ethnicity and income images"""
+    if not isinstance(city, CityArrays):
+        city = CityArrays.from_object_grid(city)
+    # The last row and column of the padding are not drawn
+    area = (slice(0, city.shape[0] - 1), slice(0, city.shape[1] - 1))
+    landmark = city.landmark[area]
+    empty = city.empty[area]
+
+    # Landmarks keep the color of their religion on the religion map
+    religion = religion_colors(max(int(city.religion.max()) + 1, total_religions))[city.religion[area]]
+    religion[empty] = EMPTY
+
+    ethnicity = ETHNICITY_COLORS[city.ethnicity[area].astype(np.intp)]
+    income = income_colors(city.income[area])
+    for frame in (ethnicity, income):
+        frame[landmark] = LANDMARK
+        frame[empty] = EMPTY
+
+    return (to_image(religion, landmark, zoom),
+            to_image(ethnicity, landmark, zoom),
+            to_image(income, landmark, zoom))
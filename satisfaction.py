@@ -0,0 +1,384 @@
+import heapq
+
+import numpy as np
+
+from city_arrays import CityArrays
+from features import builtin_count, extra_features, feature_weights, registry
+from landmark import LandmarkIndex, apply_influence
+from neighborhood import income_ratio_sum, neighbor_sum, offset_counts
+from params import landmark_decay, landmark_radius, neighborhood_shape, radius as default_radius
+
+# CategoricalFeature's default threshold, a neighbor's religion is liked if its preference is above it
+religion_threshold = 0.5
+
+
+def satisfaction_grid(city, radius=default_radius, weights=None, weighted=False, kind=neighborhood_shape,
+                      landmarks=None):
+    """Compute the satisfaction of every agent in the city at once, the same as calling
+    Agent.satisfied(neighbors(...)) for each agent
+    :param city: a CityArrays (an object grid is converted first)
+    :param radius: maximum distance to check
+    :param weights: importance of each feature in features.registry (religion, ethnicity, income, ...),
+    defaults to the city's weights
+    :param weighted: use the neighborhood of city.neighbors_weighted
+    :param kind: shape of the neighborhood, see neighborhood.py
+    :param landmarks: LandmarkIndex of the city, built with the landmark settings of params.py if None
+    :return tuple of the total satisfaction grid and one grid per feature, NaN where there is no agent"""
+    if not isinstance(city, CityArrays):
+        city = CityArrays.from_object_grid(city)
+    weights = feature_weights(city.weights if weights is None else weights)
+    agents = city.occupied
+    count = neighbor_sum(agents.astype(np.int64), radius, weighted, kind).astype(float)
+    no_neighbors = count == 0
+    safe_count = np.where(no_neighbors, 1, count)
+
+    feature_sats = []
+    for feature, weight in zip(registry, weights):
+        if weight == 0:
+            feature_sats.append(np.zeros(city.shape))
+            continue
+        matches = feature.neighbor_matches(getattr(city, feature.name), agents, radius, weighted, kind,
+                                           city.preference_matrix)
+        # np.average of an empty neighbor list is NaN
+        feature_sats.append(np.where(no_neighbors, np.nan, matches / safe_count))
+
+    # A landmark of a liked religion nearby raises religion satisfaction to its influence
+    if landmarks is None:
+        landmarks = LandmarkIndex.from_city(city, radius, kind, threshold=religion_threshold)
+    feature_sats[0] = apply_influence(feature_sats[0], landmarks.influence_grid(city.religion))
+
+    total = sum(weight * sat for weight, sat in zip(weights, feature_sats)) / sum(weights)
+    return tuple(np.where(agents, grid, np.nan) for grid in [total] + feature_sats)
+
+
+def prospect_satisfaction(city, movers, targets, radius=default_radius, weights=None, weighted=False,
+                          kind=neighborhood_shape, landmarks=None):
+    """The satisfaction each agent would have in another home, for many (agent, home) pairs at once, the
+    same as Agent.satisfied on the neighbors of the home without the agent itself
+    :param city: a CityArrays, its layers may have leading axes (e.g. several cities), neighbors are only
+    looked for along the last two
+    :param movers: flat indices of the homes of the agents
+    :param targets: flat indices of the homes they would move to, one for each agent
+    :param landmarks: LandmarkIndex of the city, built with the landmark settings of params.py if None
+    :return array of satisfactions, NaN where a home has no neighbors for a feature that has weight"""
+    weights = feature_weights(city.weights if weights is None else weights)
+    rows, cols = city.shape[-2:]
+    movers = np.asarray(movers)
+    mover = np.unravel_index(movers, city.shape)
+    target = np.unravel_index(np.asarray(targets), city.shape)
+    lead, target_x, target_y = target[:-2], target[-2], target[-1]
+    if landmarks is None:
+        landmarks = LandmarkIndex.from_city(city, radius, kind, threshold=religion_threshold)
+    agents = city.occupied
+    own_religion = city.religion[mover].astype(np.intp)
+    used = [(k, feature, getattr(city, feature.name)) for k, feature in enumerate(registry) if weights[k] != 0]
+    own = {k: layer[mover] for k, feature, layer in used}
+
+    count = np.zeros(len(movers))
+    matches = np.zeros((len(weights), len(movers)))
+    for di, dj, times in offset_counts(radius, weighted, kind):
+        xs, ys = target_x + di, target_y + dj
+        inside = (0 <= xs) & (xs < rows) & (0 <= ys) & (ys < cols)
+        cell = lead + (np.where(inside, xs, 0), np.where(inside, ys, 0))
+        present = inside & agents[cell] & (np.ravel_multi_index(cell, city.shape) != movers)
+        counted = times * present
+        count += counted
+        for k, feature, layer in used:
+            matches[k] += counted * feature.matches(own[k], layer[cell], city.preference_matrix)
+
+    no_neighbors = count == 0
+    components = np.where(no_neighbors, np.nan, matches / np.where(no_neighbors, 1, count))
+    components[[k for k in range(len(weights)) if weights[k] == 0]] = 0
+    components[0] = apply_influence(components[0], landmarks.influence(own_religion, *target))
+    return np.dot(weights, components) / sum(weights)
+
+
+def scalar_satisfaction_grid(city, radius=default_radius, kind=neighborhood_shape, landmarks=None):
+    """The reference path: call Agent.satisfied on the neighbors of every agent of an object grid
+    :param landmarks: LandmarkIndex of the city. If None, agents scan their neighbors for landmarks
+    :return grid of satisfactions, NaN where there is no agent"""
+    from city import neighbors
+
+    result = np.full(city.shape, np.nan)
+    for (x, y), house in np.ndenumerate(city):
+        if not (house.empty or house.landmark):
+            agent = house.occupant
+            influence = None if landmarks is None else landmarks.influence(agent.religion.value, x, y)
+            result[x, y] = agent.satisfied(neighbors(city, radius, x, y, agent, kind), influence)
+    return result
+
+
+class SatisfactionCache:
+    """Running neighborhood sums for every cell of the city, so that satisfaction does not have to be
+    recomputed from scratch every step. For each cell it keeps how many agent neighbors of every religion
+    and ethnicity it has and, for the agent living there, the summed income ratio with its neighbors, and
+    likewise the summed matches with its neighbors of every other feature in features.registry that has weight.
+    A move only changes the sums within the radius of the old and new home, so it is applied as a delta
+    and only the agents there are evaluated again. Values are the same as satisfaction_grid."""
+
+    def __init__(self, city, radius=default_radius, weights=None, weighted=False, kind=neighborhood_shape,
+                 threshold=0.5, income_sum=None, feature_sums=None, landmark_radius=landmark_radius,
+                 landmark_decay=landmark_decay):
+        """:param city: a CityArrays (an object grid is converted first)
+        :param threshold: an agent is satisfied if its satisfaction is above this
+        :param income_sum: running income sums to continue from (e.g. from a checkpoint), instead of
+        computing them again. Recomputed sums can differ from ones updated move by move in the last bits
+        :param feature_sums: the same for the registered features, a dict of feature name to running sums
+        :param landmark_radius: how far a landmark reaches, None for the radius, see LandmarkIndex
+        :param landmark_decay: how much the influence of a landmark drops with distance"""
+        if not isinstance(city, CityArrays):
+            city = CityArrays.from_object_grid(city)
+        self.weights = feature_weights(city.weights if weights is None else weights)
+        self.preference_matrix = city.preference_matrix
+        self.threshold = threshold
+        self.accept = city.preference_matrix > religion_threshold
+        self.radius = radius
+        self.weighted = weighted
+        self.kind = kind
+        self.offsets = np.array(offset_counts(radius, weighted, kind), dtype=np.intp).reshape(-1, 3)
+        # (index in the weights, feature) of the registered features that have weight
+        self.features = [(k, feature) for k, feature in enumerate(extra_features(), start=builtin_count)
+                         if self.weights[k] != 0]
+        # Landmarks never move, so their influence is fixed for each religion
+        self.landmarks = LandmarkIndex.from_city(city, radius, kind, landmark_radius, landmark_decay,
+                                                 religion_threshold)
+        # Heap of the cells left to visit by the scan that is going on, if any
+        self.pending = None
+        self._build(city, income_sum, feature_sums)
+
+    def rebuild(self, city):
+        """Compute all sums and satisfactions again from the city, after moves the cache wasn't told about
+        :param city: a CityArrays or an object grid"""
+        if not isinstance(city, CityArrays):
+            city = CityArrays.from_object_grid(city)
+        self._build(city)
+
+    def _build(self, city, income_sum=None, feature_sums=None):
+        radius, weighted, kind = self.radius, self.weighted, self.kind
+        self.religion = city.religion.astype(np.intp)
+        self.ethnicity = city.ethnicity.astype(np.intp)
+        self.income = city.income.astype(float)
+        self.agents = city.occupied
+        self.shape = city.shape
+
+        categories = len(self.accept)
+        self.religion_counts = np.zeros((categories,) + self.shape)
+        self.ethnicity_counts = np.zeros((2,) + self.shape)
+        for category in range(categories):
+            layer = (self.agents & (self.religion == category)).astype(np.int64)
+            self.religion_counts[category] = neighbor_sum(layer, radius, weighted, kind)
+        for category in range(2):
+            layer = (self.agents & (self.ethnicity == category)).astype(np.int64)
+            self.ethnicity_counts[category] = neighbor_sum(layer, radius, weighted, kind)
+        self.count = self.ethnicity_counts.sum(axis=0)
+        if income_sum is None and self.weights[2] == 0:
+            # Nothing reads the income sums then, so they are not kept up to date either
+            income_sum = np.zeros(self.shape)
+        elif income_sum is None:
+            income_sum = np.where(self.agents, income_ratio_sum(self.income, self.agents, radius, weighted, kind), 0)
+        self.income_sum = np.array(income_sum, dtype=float)
+        self.columns = {feature.name: getattr(city, feature.name).copy() for k, feature in self.features}
+        self.feature_sums = {}
+        for k, feature in self.features:
+            if feature_sums is not None and feature.name in feature_sums:
+                self.feature_sums[feature.name] = np.array(feature_sums[feature.name], dtype=float)
+                continue
+            matches = feature.neighbor_matches(self.columns[feature.name], self.agents, radius, weighted, kind,
+                                               self.preference_matrix)
+            self.feature_sums[feature.name] = np.where(self.agents, matches, 0)
+
+        self.satisfaction = np.full(self.shape, np.nan)
+        self.satisfied = np.zeros(self.shape, dtype=bool)
+        self.unsatisfied = set()
+        self.agent_count = int(self.agents.sum())
+        self.satisfied_count = 0
+        # Flat views of the layers, moves index them with the flat indices of the cells they touch
+        self.flat = {name: getattr(self, name).reshape(getattr(self, name).shape[:-2] + (-1,))
+                     for name in ("religion", "ethnicity", "income", "agents", "religion_counts", "ethnicity_counts",
+                                  "count", "income_sum", "satisfaction", "satisfied")}
+        self.flat_columns = {name: column.reshape(-1) for name, column in self.columns.items()}
+        self.flat_sums = {name: sums.reshape(-1) for name, sums in self.feature_sums.items()}
+        self.neighborhoods = {}
+        self._evaluate(np.flatnonzero(self.agents))
+
+    def _evaluate(self, cells):
+        """Recompute the satisfaction of the agents in the given cells from the running sums
+        :param cells: flat indices, may repeat"""
+        flat = self.flat
+        # A cell can be in both neighborhoods of a move, count it once
+        cells = np.unique(cells)
+        cells = cells[flat["agents"][cells]]
+        xs, ys = np.divmod(cells, self.shape[1])
+        count = flat["count"][cells]
+        no_neighbors = count == 0
+        safe_count = np.where(no_neighbors, 1, count)
+
+        def average(matches):
+            return np.where(no_neighbors, np.nan, matches / safe_count)
+
+        own_religion = flat["religion"][cells]
+        total = 0
+        if self.weights[0] != 0:
+            matches = (self.accept[own_religion] * flat["religion_counts"][:, cells].T).sum(axis=1)
+            total = self.weights[0] * apply_influence(average(matches),
+                                                      self.landmarks.influence(own_religion, xs, ys))
+        if self.weights[1] != 0:
+            total = total + self.weights[1] * average(flat["ethnicity_counts"][flat["ethnicity"][cells], cells])
+        if self.weights[2] != 0:
+            total = total + self.weights[2] * average(flat["income_sum"][cells])
+        for k, feature in self.features:
+            total = total + self.weights[k] * average(self.flat_sums[feature.name][cells])
+        total = total / sum(self.weights) + np.zeros(len(cells))
+
+        satisfied = total > self.threshold
+        self.satisfied_count += int(satisfied.sum()) - int(flat["satisfied"][cells].sum())
+        flat["satisfaction"][cells] = total
+        flat["satisfied"][cells] = satisfied
+        for cell, happy in zip(zip(xs.tolist(), ys.tolist()), satisfied.tolist()):
+            if happy:
+                self.unsatisfied.discard(cell)
+            else:
+                self.unsatisfied.add(cell)
+                if self.pending is not None:
+                    heapq.heappush(self.pending, cell)
+
+    def _neighborhood(self, cell):
+        """Coordinates and counts of the neighbors of a cell that are inside the grid"""
+        xs = cell[0] + self.offsets[:, 0]
+        ys = cell[1] + self.offsets[:, 1]
+        inside = (0 <= xs) & (xs < self.shape[0]) & (0 <= ys) & (ys < self.shape[1])
+        return xs[inside], ys[inside], self.offsets[inside, 2]
+
+    def _flat_neighborhood(self, cell):
+        """Flat indices and counts of the neighbors of a cell that are inside the grid, kept for the next
+        move from or to the cell"""
+        if cell not in self.neighborhoods:
+            xs, ys, counts = self._neighborhood(cell)
+            self.neighborhoods[cell] = (xs * self.shape[1] + ys, counts)
+        return self.neighborhoods[cell]
+
+    def _income_ratios(self, income, xs, ys):
+        other = self.income[xs, ys]
+        return np.minimum(income, other) / np.maximum(income, other)
+
+    def move(self, src, dst):
+        """Record that the agent at src moved into the empty home at dst, and update the satisfaction of
+        everyone within the radius of either home"""
+        flat = self.flat
+        matrix = self.preference_matrix
+        src_cell, dst_cell = src, dst
+        src = src_cell[0] * self.shape[1] + src_cell[1]
+        dst = dst_cell[0] * self.shape[1] + dst_cell[1]
+        religion, ethnicity, income = flat["religion"][src], flat["ethnicity"][src], flat["income"][src]
+        track_income = self.weights[2] != 0
+
+        # Leave the old home
+        flat["agents"][src] = False
+        flat["satisfaction"][src] = np.nan
+        flat["income_sum"][src] = 0
+        if flat["satisfied"][src]:
+            self.satisfied_count -= 1
+        flat["satisfied"][src] = False
+        self.unsatisfied.discard(src_cell)
+        old, old_counts = self._flat_neighborhood(src_cell)
+        flat["religion_counts"][religion, old] -= old_counts
+        flat["ethnicity_counts"][ethnicity, old] -= old_counts
+        flat["count"][old] -= old_counts
+        present = flat["agents"][old]
+        others, counts = old[present], old_counts[present]
+        if track_income:
+            other = flat["income"][others]
+            flat["income_sum"][others] -= counts * (np.minimum(income, other) / np.maximum(income, other))
+        for k, feature in self.features:
+            column, sums = self.flat_columns[feature.name], self.flat_sums[feature.name]
+            sums[src] = 0
+            sums[others] -= counts * feature.matches(column[others], column[src], matrix)
+
+        # Arrive in the new one
+        flat["religion"][dst], flat["ethnicity"][dst], flat["income"][dst] = religion, ethnicity, income
+        new, new_counts = self._flat_neighborhood(dst_cell)
+        flat["religion_counts"][religion, new] += new_counts
+        flat["ethnicity_counts"][ethnicity, new] += new_counts
+        flat["count"][new] += new_counts
+        present = flat["agents"][new]
+        others, counts = new[present], new_counts[present]
+        if track_income:
+            other = flat["income"][others]
+            ratios = counts * (np.minimum(income, other) / np.maximum(income, other))
+            flat["income_sum"][others] += ratios
+            flat["income_sum"][dst] = ratios.sum()
+        for k, feature in self.features:
+            column, sums = self.flat_columns[feature.name], self.flat_sums[feature.name]
+            column[dst] = column[src]
+            sums[others] += counts * feature.matches(column[others], column[dst], matrix)
+            sums[dst] = (counts * feature.matches(column[dst], column[others], matrix)).sum()
+        flat["agents"][dst] = True
+
+        self._evaluate(np.concatenate([old, new, [dst]]))
+
+    def _comparisons(self, src, xs, ys):
+        """For every feature with weight, its index in the weights and a function that compares the agent
+        living at src with the cells at xs, ys"""
+        religion = self.religion[src]
+        comparisons = [(0, lambda: self.accept[religion, self.religion[xs, ys]]),
+                       (1, lambda: self.ethnicity[xs, ys] == self.ethnicity[src]),
+                       (2, lambda: self._income_ratios(self.income[src], xs, ys))]
+        for k, feature in self.features:
+            column = self.columns[feature.name]
+            comparisons.append((k, lambda feature=feature, column=column:
+                                feature.matches(column[src], column[xs, ys], self.preference_matrix)))
+        return [(k, matches) for k, matches in comparisons if self.weights[k] != 0]
+
+    def prospect(self, src, dst):
+        """The satisfaction the agent living at src would have if it moved to the empty home at dst"""
+        xs, ys, counts = self._neighborhood(dst)
+        present = self.agents[xs, ys] & ~((xs == src[0]) & (ys == src[1]))
+        counts = counts * present
+        count = counts.sum()
+        components = [0] * len(self.weights)
+        for k, matches in self._comparisons(src, xs, ys):
+            components[k] = np.nan if count == 0 else (counts * matches()).sum() / count
+        components[0] = apply_influence(components[0], self.landmarks.influence(self.religion[src], *dst))
+        return np.average(components, weights=self.weights)
+
+    def prospects(self, src, cells):
+        """prospect for many empty homes at once
+        :param cells: list of (x, y) of the homes
+        :return array of the satisfactions the agent living at src would have in each"""
+        cells = np.array(cells, dtype=np.intp).reshape(-1, 2)
+        xs = cells[:, :1] + self.offsets[:, 0]
+        ys = cells[:, 1:] + self.offsets[:, 1]
+        inside = (0 <= xs) & (xs < self.shape[0]) & (0 <= ys) & (ys < self.shape[1])
+        xs, ys = np.where(inside, xs, 0), np.where(inside, ys, 0)
+        counts = self.offsets[:, 2] * (inside & self.agents[xs, ys] & ~((xs == src[0]) & (ys == src[1])))
+        count = counts.sum(axis=1)
+        no_neighbors = count == 0
+        components = np.zeros((len(self.weights), len(cells)))
+        for k, matches in self._comparisons(src, xs, ys):
+            components[k] = np.where(no_neighbors, np.nan,
+                                     (counts * matches()).sum(axis=1) / np.where(no_neighbors, 1, count))
+        influence = self.landmarks.influence(self.religion[src], cells[:, 0], cells[:, 1])
+        components[0] = apply_influence(components[0], influence)
+        return np.dot(self.weights, components) / sum(self.weights)
+
+    def scan(self):
+        """The homes of the unsatisfied agents, in the order time_step visits the grid. Moves made while
+        iterating are taken into account like in a scan of the whole grid: an agent ahead of the scan that
+        becomes unsatisfied, or that moves to a home ahead of it and is unsatisfied there, is still visited
+        :return generator of (x, y)"""
+        # A sorted list is already a heap
+        self.pending = sorted(self.unsatisfied)
+        last = None
+        try:
+            while self.pending:
+                cell = heapq.heappop(self.pending)
+                # Cells behind the scan wait for the next one, cells can be in the heap more than once
+                if (last is None or cell > last) and cell in self.unsatisfied:
+                    last = cell
+                    yield cell
+        finally:
+            self.pending = None
+
+    def satisfied_ratio(self):
+        """Ratio of agents that are currently satisfied"""
+        return self.satisfied_count / self.agent_count
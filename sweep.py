@@ -0,0 +1,177 @@
+"""Run the simulation for every combination of a grid of parameter values, several times each, in parallel.
+
+The grid is a JSON file mapping names of parameters in params.py to lists of values, e.g.
+{"radius": [1, 2], "weight_list": [[1, 0, 0], [0, 1, 0]]}
+Results are appended to a CSV file as runs finish. Running the same sweep again skips the runs that are
+already in the file, so an interrupted sweep can be resumed.
+
+Usage: python sweep.py grid.json --replicates 10 --seed 0 --out sweep.csv"""
+import argparse
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import params
+from batch_update import SEQUENTIAL, batch_time_step
+from city import GridMover, generate_city, time_step
+from city_arrays import CityArrays
+from cluster_counts import ClusterTracker, income_comparison
+from landmark import LandmarkIndex
+from prospects import ProspectIndex
+from satisfaction import SatisfactionCache, religion_threshold
+from vacancies import VacancyIndex
+
+# The parameters of params.py that generate_city takes, weight_list is passed as weights
+generation_settings = ("w", "h", "empty_ratio", "landmark_ratio", "min_price", "max_price", "price_noise",
+                       "price_segregation", "min_income", "max_income")
+# The other parameters a run uses, a grid over any parameter not listed would only repeat the same runs.
+# The seed is not one of them, every replicate has its own random stream spawned from the sweep's seed
+run_settings = generation_settings + ("weight_list", "generation_method", "compact_objects", "radius",
+                                      "neighborhood_shape", "landmark_radius", "landmark_decay", "update_mode",
+                                      "check_future_home", "max_iterations", "satisfaction_threshold")
+result_columns = ("steps", "satisfaction", "religion_clusters", "ethnicity_clusters", "income_comparison")
+
+
+def default_settings():
+    """All parameters of params.py"""
+    return {name: value for name, value in vars(params).items() if not name.startswith("_")}
+
+
+def parameter_grid(grid):
+    """Every combination of the values in a grid
+    :param grid: dict of parameter name to a list of values
+    :return generator of dicts of parameter name to value"""
+    names = sorted(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def replicate_rng(root_seed, replicate):
+    """The random generator of one replicate: an independent stream spawned from the root seed, the same
+    as np.random.SeedSequence(root_seed).spawn(n)[replicate]"""
+    return np.random.default_rng(np.random.SeedSequence(root_seed, spawn_key=(replicate,)))
+
+
+def run(settings, replicate, root_seed=0):
+    """Run one simulation without drawing anything. Everything it uses is passed explicitly and it has its
+    own random generator, so runs in the same worker process don't affect each other
+    :param settings: dict of parameters that differ from params.py
+    :param replicate: number of the replicate, picks the random stream
+    :param root_seed: seed that the streams of all replicates are spawned from
+    :return dict of results"""
+    config = {**default_settings(), **settings}
+    rng = replicate_rng(root_seed, replicate)
+    city = generate_city(weights=config["weight_list"], method=config["generation_method"], rng=rng,
+                         compact=config["compact_objects"], **{name: config[name] for name in generation_settings})
+    vacancies = VacancyIndex.from_city(city)
+    religion_clusters = ClusterTracker.from_city(city, "religion")
+    ethnicity_clusters = ClusterTracker.from_city(city, "ethnicity")
+    satisfactions = SatisfactionCache(city, radius=config["radius"], weights=config["weight_list"],
+                                      kind=config["neighborhood_shape"], landmark_radius=config["landmark_radius"],
+                                      landmark_decay=config["landmark_decay"])
+    sequential = config["update_mode"] == SEQUENTIAL
+    prospects = ProspectIndex(satisfactions, vacancies) if config["check_future_home"] and sequential else None
+    if not sequential:
+        # Batch steps work on arrays, the object grid and everything that tracks it follow their moves
+        arrays = CityArrays.from_object_grid(city, weights=config["weight_list"])
+        landmarks = LandmarkIndex.from_city(arrays, config["radius"], config["neighborhood_shape"],
+                                            config["landmark_radius"], config["landmark_decay"], religion_threshold)
+        batch_observers = (GridMover(city), vacancies, satisfactions, religion_clusters, ethnicity_clusters)
+
+    avg_satisfaction = satisfactions.satisfied_ratio()
+    steps = 0
+    for i in range(0, config["max_iterations"]):
+        if sequential:
+            avg_satisfaction = time_step(i, city, vacancies, observers=(religion_clusters, ethnicity_clusters),
+                                         cache=satisfactions, rng=rng, radius=config["radius"],
+                                         check_future_home=config["check_future_home"],
+                                         kind=config["neighborhood_shape"], verbose=False, prospects=prospects)
+        else:
+            batch_time_step(arrays, rng, config["radius"], config["weight_list"], kind=config["neighborhood_shape"],
+                            mode=config["update_mode"], check_future_home=config["check_future_home"],
+                            observers=batch_observers, landmarks=landmarks)
+            avg_satisfaction = satisfactions.satisfied_ratio()
+        steps = i + 1
+        if avg_satisfaction > config["satisfaction_threshold"]:
+            break
+
+    return {"steps": steps,
+            "satisfaction": avg_satisfaction,
+            "religion_clusters": religion_clusters.count,
+            "ethnicity_clusters": ethnicity_clusters.count,
+            "income_comparison": income_comparison(city)}
+
+
+def csv_value(value):
+    """How a parameter value is written to the results file: lists and dicts as JSON, anything else as text"""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _run_key(names, settings, replicate):
+    return tuple(csv_value(settings[name]) for name in names) + (str(replicate),)
+
+
+def completed_runs(out, names):
+    """Keys of the runs that are already in the results file"""
+    if not os.path.exists(out):
+        return set()
+    with open(out, newline="") as file:
+        rows = csv.DictReader(file)
+        # A row cut off by an interruption is missing its last columns, and is run again
+        return {tuple(row[name] for name in names) + (row["replicate"],)
+                for row in rows if row.get(result_columns[-1])}
+
+
+def sweep(grid, replicates, out, workers=None, root_seed=0):
+    """Run every combination of the grid once per replicate in a process pool, appending results to a CSV file
+    :param grid: dict of parameter name to a list of values
+    :param replicates: list of replicate numbers, each has its own random stream
+    :param out: path of the CSV file
+    :param workers: number of processes, defaults to the number of cores
+    :param root_seed: seed the random streams of the replicates are spawned from"""
+    unknown = set(grid) - set(default_settings())
+    if unknown:
+        raise ValueError(f"Not parameters in params.py: {', '.join(sorted(unknown))}")
+    unused = set(grid) - set(run_settings)
+    if unused:
+        raise ValueError(f"Parameters a sweep run doesn't use: {', '.join(sorted(unused))}")
+    names = sorted(grid)
+    done = completed_runs(out, names)
+    runs = [(settings, replicate) for settings in parameter_grid(grid) for replicate in replicates
+            if _run_key(names, settings, replicate) not in done]
+    print(f"{len(done)} runs already done, {len(runs)} to go")
+
+    write_header = not os.path.exists(out) or os.path.getsize(out) == 0
+    with open(out, "a", newline="") as file, ProcessPoolExecutor(workers) as pool:
+        writer = csv.DictWriter(file, fieldnames=names + ["replicate"] + list(result_columns))
+        if write_header:
+            writer.writeheader()
+        futures = {pool.submit(run, settings, replicate, root_seed): (settings, replicate)
+                   for settings, replicate in runs}
+        for future in as_completed(futures):
+            settings, replicate = futures[future]
+            row = {name: csv_value(settings[name]) for name in names}
+            row.update(replicate=replicate, **future.result())
+            writer.writerow(row)
+            # Make sure finished runs are on disk in case the sweep is interrupted
+            file.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of the simulation")
+    parser.add_argument("grid", help="JSON file mapping parameter names to lists of values")
+    parser.add_argument("--replicates", type=int, default=1, help="number of replicates of every combination")
+    parser.add_argument("--seed", type=int, default=0, help="root seed the replicates' random streams come from")
+    parser.add_argument("--out", default="sweep.csv", help="CSV file to append the results to")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, default all cores")
+    args = parser.parse_args()
+
+    with open(args.grid) as grid_file:
+        parameter_values = json.load(grid_file)
+    sweep(parameter_values, list(range(args.replicates)), args.out, args.workers, args.seed)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import features
+from city import generate_city
+from city_arrays import CityArrays
+from features import CategoricalColumn, register
+
+
+@pytest.fixture
+def ethnic_group():
+    """The example feature of features.py, registered for the duration of a test"""
+    feature = register(CategoricalColumn("ethnic_group", np.identity(7), categories=7))
+    yield feature
+    features.registry.remove(feature)
+
+
+def test_compact_reference_city_with_a_categorical_feature(ethnic_group):
+    city = generate_city(8, 8, [1, 0, 0, 0], method="reference", compact=True, rng=np.random.default_rng(0))
+    agents = [house.occupant for house in city.flat if not (house.empty or house.landmark)]
+    values = {agent.ethnic_group.value for agent in agents}
+    assert values <= set(range(7))
+    assert all(type(value) is int for value in values)
+    # Agents with the same value share one feature object
+    assert len({id(agent.ethnic_group) for agent in agents}) == len(values)
+    arrays = CityArrays.from_object_grid(city)
+    occupied = [(x, y) for (x, y), house in np.ndenumerate(city) if not (house.empty or house.landmark)]
+    assert [arrays.ethnic_group[cell] for cell in occupied] == [city[cell].occupant.ethnic_group.value
+                                                               for cell in occupied]
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from city_arrays import CityArrays
+from landmark import LandmarkIndex
+from satisfaction import SatisfactionCache, prospect_satisfaction, satisfaction_grid, scalar_satisfaction_grid
+
+
+def lone_agent_city(landmark_religion):
+    """An agent whose only neighbor is a landmark, everything else is empty"""
+    city = CityArrays((5, 5), weights=[1, 0, 0])
+    city.empty[2, 2] = False
+    city.religion[2, 2] = 1
+    city.income[2, 2] = 500
+    city.empty[1, 1] = False
+    city.landmark[1, 1] = True
+    city.religion[1, 1] = landmark_religion
+    return city
+
+
+@pytest.mark.parametrize("landmark_religion, expected", [(2, np.nan), (1, 1.0)])
+def test_agent_next_to_only_a_landmark(landmark_religion, expected):
+    city = lone_agent_city(landmark_religion)
+    cache = SatisfactionCache(city, radius=1)
+    grid = city.to_object_grid()
+    landmarks = LandmarkIndex.from_city(city, 1)
+    mover, home = np.ravel_multi_index(([2], [2]), city.shape), np.ravel_multi_index(([2], [1]), city.shape)
+    results = [satisfaction_grid(city, 1)[0][2, 2],
+               scalar_satisfaction_grid(grid, 1)[2, 2],
+               scalar_satisfaction_grid(grid, 1, landmarks=landmarks)[2, 2],
+               cache.satisfaction[2, 2],
+               prospect_satisfaction(city, mover, home, 1)[0],
+               cache.prospect((2, 2), (2, 1)),
+               cache.prospects((2, 2), [(2, 1)])[0]]
+    np.testing.assert_array_equal(results, [expected] * len(results))
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from city import generate_city, time_step
+from satisfaction import SatisfactionCache
+from vacancies import VacancyIndex
+
+
+class MoveLog:
+    """Observer that records every move"""
+
+    def __init__(self):
+        self.moves = []
+
+    def move(self, src, dst):
+        self.moves.append((src, dst))
+
+
+def run_steps(seed, steps, cached, check_future_home=False, scan_ratio=0.1):
+    weights = [1, 1, 1]
+    city = generate_city(16, 16, weights, rng=np.random.default_rng(seed))
+    vacancies = VacancyIndex.from_city(city)
+    cache = SatisfactionCache(city, radius=1, weights=weights) if cached else None
+    log = MoveLog()
+    rng = np.random.default_rng(seed + 1000)
+    moves = []
+    for i in range(steps):
+        time_step(i, city, vacancies, observers=[log], cache=cache, rng=rng, radius=1,
+                  check_future_home=check_future_home, verbose=False, scan_ratio=scan_ratio)
+        moves.append(log.moves)
+        log.moves = []
+    return moves
+
+
+# 0 always falls back to visiting every agent, 1 always moves agents through the cache
+@pytest.mark.parametrize("scan_ratio", [0, 0.1, 1])
+@pytest.mark.parametrize("seed", range(10))
+def test_cached_time_step_makes_the_same_moves(seed, scan_ratio):
+    assert run_steps(seed, 3, cached=True, scan_ratio=scan_ratio) == run_steps(seed, 3, cached=False)
+
+
+@pytest.mark.parametrize("scan_ratio", [0, 1])
+@pytest.mark.parametrize("seed", range(3))
+def test_cached_time_step_makes_the_same_moves_checking_future_home(seed, scan_ratio):
+    assert run_steps(seed, 2, cached=True, check_future_home=True, scan_ratio=scan_ratio) == \
+        run_steps(seed, 2, cached=False, check_future_home=True)
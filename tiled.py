@@ -0,0 +1,200 @@
+"""Run the batch simulation of batch_update.py on very large cities, using every core of the machine.
+
+The city's layers are put in shared memory and the grid is split into strips of rows. A pool of worker
+processes computes the satisfaction of each strip in parallel, from the strip plus a halo of `radius` rows
+on either side, which is all its agents can see. Matching unsatisfied agents to empty homes is done for the
+whole city at the step boundary, so moves between strips need no special care, and proposals of agents that
+check their future home are scored in parallel. Cluster counts are labelled per strip in parallel and the
+clusters that touch across strip borders are merged. The results are the same as batch_time_step on one core.
+
+Usage: python tiled.py --size 4096 --steps 50 --workers 8 --out tiled.csv"""
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import params
+from batch_update import RANDOM_SEQUENTIAL, SYNCHRONOUS, batch_time_step
+from city_arrays import CityArrays
+from cluster_counts import label_clusters, union_roots
+from generation import generate_city_arrays
+from landmark import LandmarkIndex
+from render import render_frames
+from satisfaction import prospect_satisfaction, religion_threshold, satisfaction_grid
+
+# The shared layers and settings of a worker process, set by _attach
+_worker = {}
+
+
+def _attach(specs, settings):
+    """Initializer of a worker process: map the shared layers of the city"""
+    memory = {name: SharedMemory(name=block) for name, (block, dtype, shape) in specs.items()}
+    layers = {name: np.ndarray(shape, dtype=dtype, buffer=memory[name].buf)
+              for name, (block, dtype, shape) in specs.items()}
+    city = CityArrays((0, 0), settings["preference_matrix"], settings["weights"])
+    for name in city.layers:
+        setattr(city, name, layers[name])
+    landmarks = LandmarkIndex(layers["landmark_nearest"], settings["landmark_strengths"])
+    _worker.update(memory=memory, layers=layers, city=city, landmarks=landmarks, **settings)
+
+
+def _strip_satisfied(start, stop):
+    """Compute which agents of rows start:stop are satisfied, into the shared `satisfied` layer"""
+    city, radius = _worker["city"], _worker["radius"]
+    low, high = max(start - radius, 0), min(stop + radius, city.shape[0])
+    total = satisfaction_grid(city.row_band(low, high), radius, _worker["weights"], _worker["weighted"],
+                              _worker["kind"], _worker["landmarks"].row_band(low, high))[0]
+    _worker["layers"]["satisfied"][start:stop] = total[start - low:stop - low] > 0.5
+
+
+def _strip_prospects(movers, homes):
+    return prospect_satisfaction(_worker["city"], movers, homes, _worker["radius"], _worker["weights"],
+                                 _worker["weighted"], _worker["kind"], _worker["landmarks"])
+
+
+def _strip_clusters(feature, start, stop, cols):
+    """Label the clusters of rows start:stop into the shared `labels` layer, numbered from 0 in each strip
+    :return sizes of the clusters"""
+    city = _worker["city"]
+    labels, sizes = label_clusters(getattr(city, feature)[start:stop, :cols], city.occupied[start:stop, :cols])
+    _worker["layers"]["labels"][start:stop, :cols] = labels
+    return sizes
+
+
+class TiledCity:
+    """A CityArrays in shared memory with a pool of worker processes that each take strips of rows"""
+
+    def __init__(self, city, workers=None, tiles=None, radius=params.radius, weights=None, weighted=False,
+                 kind=params.neighborhood_shape):
+        """:param city: CityArrays to simulate, it is copied into shared memory
+        :param workers: number of processes, defaults to the number of cores
+        :param tiles: number of strips the grid is split into, defaults to the number of workers"""
+        self.workers = workers or os.cpu_count()
+        self.tiles = min(tiles or self.workers, city.shape[0] - 1)
+        self.radius = radius
+        self.weights = city.weights if weights is None else weights
+        self.weighted = weighted
+        self.kind = kind
+        self.city = CityArrays((0, 0), city.preference_matrix, city.weights, city.income_threshold)
+        self.memory = []
+        specs = {}
+        layers = {name: getattr(city, name) for name in city.layers}
+        layers["satisfied"] = np.zeros(city.shape, dtype=np.bool_)
+        layers["labels"] = np.full(city.shape, -1, dtype=np.int64)
+        # Landmarks reach further than the halo of a strip if landmark_radius is larger than the radius, so
+        # their index is built once for the whole city and shared
+        landmarks = LandmarkIndex.from_city(city, radius, kind, threshold=religion_threshold)
+        layers["landmark_nearest"] = landmarks.nearest
+        for name, layer in layers.items():
+            block = SharedMemory(create=True, size=max(layer.nbytes, 1))
+            self.memory.append(block)
+            shared = np.ndarray(layer.shape, dtype=layer.dtype, buffer=block.buf)
+            shared[...] = layer
+            specs[name] = (block.name, layer.dtype.str, layer.shape)
+            setattr(self.city, name, shared)
+        self.bounds = np.linspace(0, city.shape[0], self.tiles + 1).astype(int)
+        settings = dict(radius=radius, weights=self.weights, weighted=weighted, kind=kind,
+                        preference_matrix=city.preference_matrix, landmark_strengths=landmarks.strengths)
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_attach, initargs=(specs, settings))
+
+    def satisfied(self):
+        """Which cells hold a satisfied agent, computed strip by strip in parallel
+        :return flat boolean array"""
+        list(self.pool.map(_strip_satisfied, self.bounds[:-1], self.bounds[1:]))
+        return self.city.satisfied.ravel()
+
+    def prospect(self, movers, homes):
+        """prospect_satisfaction of every (agent, home) pair, in parallel"""
+        parts = np.array_split(np.arange(len(movers)), self.workers)
+        results = self.pool.map(_strip_prospects, [movers[part] for part in parts], [homes[part] for part in parts])
+        return np.concatenate(list(results))
+
+    def step(self, rng, mode=SYNCHRONOUS, batches=10, check_future_home=False, proposals=10, observers=()):
+        """One batch_time_step of the city, with satisfaction and prospects computed by the workers
+        :return ratio of agents that were satisfied at the start of the step"""
+        return batch_time_step(self.city, rng, self.radius, self.weights, self.weighted, self.kind, mode, batches,
+                               check_future_home, proposals, observers, satisfied=self.satisfied,
+                               prospect=self.prospect)
+
+    def satisfied_ratio(self):
+        return self.satisfied()[self.city.occupied.ravel()].mean()
+
+    def cluster_stats(self, feature):
+        """The clusters of a feature ("religion" or "ethnicity") over the same area as
+        cluster_counts.cluster_stats: every strip is labelled in parallel, then the clusters that touch
+        across the border between two strips are joined
+        :return tuple of number of clusters, mean cluster size and the sizes of all clusters"""
+        rows, cols = self.city.shape[0] - 1, self.city.shape[1] - 1
+        bounds = np.linspace(0, rows, self.tiles + 1).astype(int)
+        strip_sizes = list(self.pool.map(_strip_clusters, [feature] * self.tiles, bounds[:-1], bounds[1:],
+                                         [cols] * self.tiles))
+        offsets = np.cumsum([0] + [len(sizes) for sizes in strip_sizes])
+        values = getattr(self.city, feature)
+        first = []
+        second = []
+        for k, border in enumerate(bounds[1:-1], start=1):
+            above = self.city.labels[border - 1, :cols]
+            below = self.city.labels[border, :cols]
+            joined = (above >= 0) & (below >= 0) & (values[border - 1, :cols] == values[border, :cols])
+            first.append(above[joined] + offsets[k - 1])
+            second.append(below[joined] + offsets[k])
+        pairs = (np.concatenate(first), np.concatenate(second)) if first else (np.zeros(0, int), np.zeros(0, int))
+        roots = union_roots(offsets[-1], *pairs)
+        groups = np.unique(roots)
+        sizes = np.bincount(roots, weights=np.concatenate(strip_sizes), minlength=offsets[-1])[groups].astype(int)
+        return len(sizes), sizes.mean() if len(sizes) else 0, sizes
+
+    def close(self):
+        """Stop the workers and free the shared memory, the city can't be used after this"""
+        self.pool.shutdown()
+        for name in self.city.layers + ("satisfied", "labels", "landmark_nearest"):
+            setattr(self.city, name, None)
+        for block in self.memory:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a big city on all cores with batch updates")
+    parser.add_argument("--size", type=int, default=4096, help="width and height of the city")
+    parser.add_argument("--steps", type=int, default=params.max_iterations)
+    parser.add_argument("--workers", type=int, help="number of processes, defaults to the number of cores")
+    parser.add_argument("--tiles", type=int, help="number of strips, defaults to the number of workers")
+    parser.add_argument("--mode", choices=[SYNCHRONOUS, RANDOM_SEQUENTIAL], default=SYNCHRONOUS)
+    parser.add_argument("--seed", type=int, default=params.seed)
+    parser.add_argument("--cluster-every", type=int, default=10, help="count clusters every N steps")
+    parser.add_argument("--out", default="tiled.csv", help="CSV file for the metrics of every step")
+    parser.add_argument("--image", help="save the religion frame of the last step to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    city = generate_city_arrays(args.size, args.size, params.weight_list, params.empty_ratio,
+                                params.landmark_ratio, params.min_price, params.max_price, params.price_noise,
+                                params.price_segregation, params.min_income, params.max_income, rng=rng)
+    with TiledCity(city, args.workers, args.tiles) as tiled, open(args.out, "w", newline="") as file:
+        del city
+        writer = csv.writer(file)
+        writer.writerow(["step", "seconds", "satisfaction", "religion_clusters", "ethnicity_clusters"])
+        for i in range(args.steps):
+            start = time.perf_counter()
+            satisfaction = tiled.step(rng, args.mode, check_future_home=params.check_future_home)
+            seconds = time.perf_counter() - start
+            clusters = ["", ""]
+            if i % args.cluster_every == 0:
+                clusters = [tiled.cluster_stats("religion")[0], tiled.cluster_stats("ethnicity")[0]]
+            writer.writerow([i, seconds, satisfaction] + clusters)
+            print(f"step {i}: {seconds:.2f}s, satisfaction {satisfaction:.3f}")
+            if satisfaction > params.satisfaction_threshold:
+                break
+        if args.image:
+            render_frames(tiled.city, zoom=1)[0].save(args.image)
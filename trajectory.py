@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+
+from city_arrays import CityArrays
+from features import extra_features
+
+# Layers that change when agents move, stored in full at every keyframe
+moving_layers = {"religion": np.int8, "ethnicity": np.bool_, "income": np.float32, "empty": np.bool_}
+
+
+def _moving_layers():
+    """moving_layers and the layers of the features registered in features.py"""
+    return dict(moving_layers, **{feature.name: feature.dtype for feature in extra_features()})
+
+
+def _open_array(path, dtype, shape_tail=()):
+    """Memory-map a file of raw records, without reading it"""
+    record = np.dtype(dtype).itemsize * int(np.prod(shape_tail, dtype=np.int64))
+    count = os.path.getsize(path) // record if os.path.exists(path) else 0
+    if count == 0:
+        return np.zeros((0,) + tuple(shape_tail), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,) + tuple(shape_tail))
+
+
+class TrajectoryRecorder:
+    """Records how the city changes over time in a directory on disk. The first state is stored in full,
+    after that only the moves of every step (old and new home of each agent that moved), plus a full copy
+    of the changing layers every keyframe_every steps so that any step can be read back quickly.
+
+    Pass it to time_step as an observer, and call end_step after every step."""
+
+    def __init__(self, path, city, keyframe_every=1000, resume_step=None):
+        """:param path: directory to write to
+        :param city: object grid or CityArrays, the state at the start (or at resume_step)
+        :param keyframe_every: store all layers every N steps
+        :param resume_step: continue a trajectory written earlier from this step on, dropping later ones"""
+        if not isinstance(city, CityArrays):
+            city = CityArrays.from_object_grid(city)
+        self.path = path
+        self.city = city.copy()
+        self.keyframe_every = keyframe_every
+        self.moves = []
+        os.makedirs(path, exist_ok=True)
+        if resume_step is None:
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            np.savez(os.path.join(path, "initial.npz"), price=city.price, landmark=city.landmark,
+                     preference_matrix=city.preference_matrix, weights=np.array(city.weights, dtype=float),
+                     keyframe_every=np.array(keyframe_every),
+                     **{name: getattr(city, name) for name in _moving_layers()})
+            self.step = 0
+        else:
+            self._truncate(resume_step)
+            self.step = resume_step
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _truncate(self, step):
+        ends = _open_array(self._file("steps.bin"), np.int64)
+        moves = int(ends[step - 1]) if step else 0
+        keyframes = _open_array(self._file("keyframes.bin"), np.int64)
+        kept = int(np.searchsorted(keyframes, step, side="right"))
+        del ends, keyframes
+        cells = self.city.empty.size
+        sizes = {"steps.bin": 8 * step, "moves.bin": 2 * 8 * moves, "keyframes.bin": 8 * kept}
+        for name, dtype in _moving_layers().items():
+            sizes[f"keyframe_{name}.bin"] = kept * cells * np.dtype(dtype).itemsize
+        for name, size in sizes.items():
+            if os.path.exists(self._file(name)):
+                with open(self._file(name), "r+b") as file:
+                    file.truncate(size)
+
+    def move(self, src, dst):
+        """Record that the agent at src moved into the empty home at dst"""
+        self.city.move(src, dst)
+        self.moves.append((np.ravel_multi_index(src, self.city.shape), np.ravel_multi_index(dst, self.city.shape)))
+
+    def end_step(self):
+        """Write the moves of the step that just ended"""
+        moves = np.array(self.moves, dtype=np.int64).reshape(-1, 2)
+        with open(self._file("moves.bin"), "ab") as file:
+            moves.tofile(file)
+        ends = _open_array(self._file("steps.bin"), np.int64)
+        total = (int(ends[-1]) if len(ends) else 0) + len(moves)
+        del ends
+        with open(self._file("steps.bin"), "ab") as file:
+            np.array([total], dtype=np.int64).tofile(file)
+        self.moves = []
+        self.step += 1
+        if self.step % self.keyframe_every == 0:
+            with open(self._file("keyframes.bin"), "ab") as file:
+                np.array([self.step], dtype=np.int64).tofile(file)
+            for name in _moving_layers():
+                with open(self._file(f"keyframe_{name}.bin"), "ab") as file:
+                    getattr(self.city, name).tofile(file)
+
+
+class Trajectory:
+    """Reads a trajectory written by TrajectoryRecorder. Nothing is loaded until it is asked for, the
+    moves and keyframes are memory-mapped"""
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(os.path.join(path, "initial.npz")) as data:
+            self.initial = {name: data[name] for name in data.files}
+        self.shape = self.initial["empty"].shape
+        self.ends = _open_array(os.path.join(path, "steps.bin"), np.int64)
+        self.all_moves = _open_array(os.path.join(path, "moves.bin"), np.int64, (2,))
+        self.keyframes = _open_array(os.path.join(path, "keyframes.bin"), np.int64)
+        self.keyframe_layers = {name: _open_array(os.path.join(path, f"keyframe_{name}.bin"), dtype, self.shape)
+                                for name, dtype in _moving_layers().items()}
+
+    def __len__(self):
+        """Number of states: the initial one and one after every recorded step"""
+        return len(self.ends) + 1
+
+    def moves(self, step):
+        """The moves made during a step (counting from 0), as flat (old home, new home) indices"""
+        start = int(self.ends[step - 1]) if step else 0
+        return self.all_moves[start:int(self.ends[step])]
+
+    def state(self, step):
+        """The city after the given number of steps, rebuilt from the closest earlier keyframe
+        :return CityArrays"""
+        if not 0 <= step < len(self):
+            raise IndexError(f"Step {step} is not in a trajectory of {len(self)} states")
+        city = CityArrays(self.shape, preference_matrix=self.initial["preference_matrix"],
+                          weights=self.initial["weights"].tolist())
+        city.price[...] = self.initial["price"]
+        city.landmark[...] = self.initial["landmark"]
+        keyframe = int(np.searchsorted(self.keyframes, step, side="right")) - 1
+        if keyframe >= 0:
+            start = int(self.keyframes[keyframe])
+            for name in _moving_layers():
+                getattr(city, name)[...] = self.keyframe_layers[name][keyframe]
+        else:
+            start = 0
+            for name in _moving_layers():
+                getattr(city, name)[...] = self.initial[name]
+        first = int(self.ends[start - 1]) if start else 0
+        last = int(self.ends[step - 1]) if step else 0
+        for src, dst in np.asarray(self.all_moves[first:last]).tolist():
+            city.move(np.unravel_index(src, self.shape), np.unravel_index(dst, self.shape))
+        return city
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class VacancyIndex:
+    """The set of empty homes in a city, with O(1) insertion, removal and random sampling.
+
+    Cells are kept in a list, and a dict maps each cell to its position in the list so that a removed
+    cell can be swapped with the last one instead of shifting the list."""
+
+    def __init__(self, cells=()):
+        self.cells = []
+        self.position = {}
+        for cell in cells:
+            self.add(cell)
+
+    @classmethod
+    def from_city(cls, city):
+        """Index the empty homes of an object grid or a CityArrays"""
+        if isinstance(city, np.ndarray):
+            return cls(cell for cell, house in np.ndenumerate(city) if house.empty)
+        return cls(zip(*np.nonzero(city.empty)))
+
+    def add(self, cell):
+        cell = tuple(int(c) for c in cell)
+        if cell in self.position:
+            return
+        self.position[cell] = len(self.cells)
+        self.cells.append(cell)
+
+    def remove(self, cell):
+        cell = tuple(int(c) for c in cell)
+        index = self.position.pop(cell)
+        last = self.cells.pop()
+        if index < len(self.cells):
+            self.cells[index] = last
+            self.position[last] = index
+
+    def sample(self, rng):
+        """A uniformly random empty home
+        :param rng: numpy random Generator"""
+        return self.at(rng.random())
+
+    def at(self, u):
+        """The empty home picked by a uniform random number u in [0, 1), for when numbers are drawn in bulk"""
+        return self.cells[int(u * len(self.cells))]
+
+    def move(self, src, dst):
+        """Record that the agent at src moved into the empty home at dst"""
+        self.remove(dst)
+        self.add(src)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, cell):
+        return tuple(cell) in self.position
+
+    def __iter__(self):
+        # Iterate over a copy so the index can be changed while looping
+        return iter(list(self.cells))